@@ -1,6 +1,31 @@
 #!/usr/bin/env bash
 
-# Always refresh av on startup
-freshclam -v -u clamav
-clamd
-python processor/worker/virus_scanner/__init__.py
+# prints how long the startup phase took, the phase start timestamp is passed as the second argument
+function phase_completed() {
+    echo "Startup phase $1 completed in $(( $(date +%s) - $2 )) seconds"
+}
+
+# freshclam - definitions are updated by freshclam, then clamd is started before the worker.
+# snapshot - definitions are copied from VIRUS_DEFINITIONS_SNAPSHOT_DIR if it's set, otherwise the image ones are used.
+# clamd loads them in background while the worker waits for it to reply to PING before receiving messages
+CLAMAV_DEFINITIONS_SOURCE="${CLAMAV_DEFINITIONS_SOURCE:-freshclam}"
+PHASE_START="$(date +%s)"
+if [[ "${CLAMAV_DEFINITIONS_SOURCE}" == "snapshot" ]]; then
+    if [[ -n "${VIRUS_DEFINITIONS_SNAPSHOT_DIR}" ]]; then
+        # only newer files are copied
+        cp -u "${VIRUS_DEFINITIONS_SNAPSHOT_DIR}"/*.c[vl]d /var/lib/clamav/ \
+            && chown clamav:clamav /var/lib/clamav/*.c[vl]d \
+            || echo "Failed to copy definitions snapshot from ${VIRUS_DEFINITIONS_SNAPSHOT_DIR}, using image definitions"
+    fi
+    phase_completed definitions "${PHASE_START}"
+    clamd &
+else
+    # Always refresh av on startup
+    freshclam -v -u clamav
+    phase_completed freshclam "${PHASE_START}"
+    PHASE_START="$(date +%s)"
+    clamd
+    phase_completed clamd "${PHASE_START}"
+fi
+# the worker replaces the shell to receive SIGTERM directly
+exec python processor/worker/virus_scanner/__init__.py
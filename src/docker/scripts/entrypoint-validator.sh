@@ -1,3 +1,4 @@
 #!/usr/bin/env bash
 
-python processor/worker/validator/__init__.py
+# the worker replaces the shell to receive SIGTERM directly
+exec python processor/worker/validator/__init__.py
@@ -1 +1,2 @@
-python processor/worker/virus_definitions_updater/__init__.py
+# the worker replaces the shell to receive SIGTERM directly
+exec python processor/worker/virus_definitions_updater/__init__.py
@@ -22,9 +22,8 @@ function main() {
         *)
             ENTRYPOINT_SCRIPT="./docker/scripts/entrypoint-${APP_RUN_MODE,,}.sh"
             if [[ -f "${ENTRYPOINT_SCRIPT}" ]]; then
-                ${ENTRYPOINT_SCRIPT} "$@"
-                KILL_LIST+=($!)
-		        echo "DEBUG: my KILL_LIST is '$KILL_LIST'"
+                # replacing the shell, so the worker runs as PID 1 and receives SIGTERM from the orchestrator
+                exec "${ENTRYPOINT_SCRIPT}" "$@"
             else
                 echo "ERROR: entrypoint script missing for ${APP_RUN_MODE} mode"
                 RESULT=2 && exit
@@ -0,0 +1,449 @@
+import time
+import socket
+import struct
+import threading
+import contextlib
+import collections
+
+
+# INSTREAM chunk size, bytes
+CHUNK_SIZE = 64 * 1024
+
+
+class ClamdError(Exception):
+    pass
+
+
+class ClamdTimeout(ClamdError):
+    pass
+
+
+# clamd can't be connected or the connection is broken
+class ClamdConnectionError(ClamdError):
+    pass
+
+
+# socket errors are raised as ClamdConnectionError, so they can't be mistaken
+# for errors of the scanned file object which are OSError as well
+@contextlib.contextmanager
+def connection_errors():
+    try:
+        yield
+    except OSError as e:
+        raise ClamdConnectionError(f'{e.__class__.__name__}: {e}') from e
+
+
+def send(sock, data):
+    with connection_errors():
+        sock.sendall(data)
+
+
+# reads the reply of z prefixed command, such replies are terminated by \0
+def read_reply(sock):
+    data = b''
+    while not data.endswith(b'\0'):
+        with connection_errors():
+            chunk = sock.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    if not data:
+        raise ClamdError('Connection closed by clamd')
+    return data.rstrip(b'\0').decode('utf8', errors='replace').strip()
+
+
+# returns signature name if a virus was found and None otherwise
+def parse_scan_reply(reply):
+    # reply format: "<file or stream>: <OK|<signature> FOUND|<message> ERROR>"
+    result = reply.rpartition(': ')[2]
+    if result == 'OK':
+        return None
+    if result.endswith(' FOUND'):
+        return result[:-len(' FOUND')]
+    raise ClamdError(reply)
+
+
+# limits the socket timeout by the time left until the deadline
+def limit_timeout(sock, timeout, deadline):
+    if deadline is None:
+        return
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise ClamdTimeout('Scan deadline exceeded')
+    sock.settimeout(remaining if timeout is None else min(timeout, remaining))
+
+
+# returns virus definitions version from VERSION reply, None if it's unknown
+def parse_definitions_version(reply):
+    # e.g. ClamAV 0.102.4/25000/Mon Oct 19 12:00:00 2026
+    parts = reply.split('/')
+    return parts[1] if len(parts) > 2 else None
+
+
+# sends INSTREAM chunks, the command must be sent already
+def send_stream(sock, fileobj, chunk_size=CHUNK_SIZE, deadline=None):
+    timeout = sock.gettimeout()
+    try:
+        while True:
+            limit_timeout(sock, timeout, deadline)
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                break
+            send(sock, struct.pack('!L', len(chunk)))
+            send(sock, chunk)
+        send(sock, struct.pack('!L', 0))
+    except ClamdConnectionError as e:
+        # clamd closes the connection after replying with an error, e.g. when StreamMaxLength is exceeded
+        if not isinstance(e.__cause__, (BrokenPipeError, ConnectionResetError)):
+            raise
+
+
+# sends INSTREAM chunks and returns the result of read_scan_reply, the command must be sent already.
+# Raises ClamdTimeout if the scan is not completed in timeout seconds,
+# the connection must be closed then to cancel the scan
+def scan_stream(sock, fileobj, read_scan_reply, chunk_size=CHUNK_SIZE, timeout=None):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    sock_timeout = sock.gettimeout()
+    try:
+        send_stream(sock, fileobj, chunk_size, deadline)
+        limit_timeout(sock, sock_timeout, deadline)
+        return read_scan_reply()
+    except ClamdConnectionError as e:
+        if isinstance(e.__cause__, socket.timeout):
+            raise ClamdTimeout(f'Scan is not completed in {timeout} seconds') from e
+        raise
+    finally:
+        sock.settimeout(sock_timeout)
+
+
+class Clamd:
+
+    def __init__(
+        self,
+        socket_path=None,
+        host=None,
+        port=3310,
+        timeout=None
+    ):
+        # TCP connection is used if host is set
+        self.socket_path = socket_path
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    # endpoint: unix socket path or host[:port]
+    @classmethod
+    def from_endpoint(cls, endpoint, timeout=None):
+        if endpoint.startswith('/'):
+            return cls(socket_path=endpoint, timeout=timeout)
+        host, separator, port = endpoint.partition(':')
+        return cls(host=host, port=int(port) if port else 3310, timeout=timeout)
+
+    @property
+    def name(self):
+        return f'{self.host}:{self.port}' if self.host else self.socket_path
+
+    def connect(self):
+        with connection_errors():
+            if self.host:
+                return socket.create_connection((self.host, self.port), timeout=self.timeout)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            return sock
+
+    def command(self, name):
+        with self.connect() as sock:
+            send(sock, f'z{name}\0'.encode())
+            return read_reply(sock)
+
+    def ping(self):
+        return self.command('PING') == 'PONG'
+
+    def version(self):
+        return self.command('VERSION')
+
+    # clamd reloads virus definitions in background after replying
+    def reload(self):
+        return self.command('RELOAD')
+
+    # sends fileobj content to clamd in chunks,
+    # returns signature name if a virus was found and None otherwise
+    def instream(self, fileobj, chunk_size=CHUNK_SIZE, timeout=None):
+        with self.connect() as sock:
+            send(sock, b'zINSTREAM\0')
+            return scan_stream(
+                sock,
+                fileobj,
+                lambda: parse_scan_reply(read_reply(sock)),
+                chunk_size=chunk_size,
+                timeout=timeout
+            )
+
+    def session(self):
+        return ClamdSession(self.connect())
+
+
+# persistent connection running commands one by one in clamd IDSESSION mode
+class ClamdSession:
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.last_id = 0
+        self.last_used = time.monotonic()
+        try:
+            send(sock, b'zIDSESSION\0')
+        except ClamdConnectionError:
+            sock.close()
+            raise
+
+    def send_command(self, name):
+        self.last_id += 1
+        send(self.sock, f'z{name}\0'.encode())
+
+    # session replies are prefixed with the command number: "<id>: <reply>"
+    def read_reply(self):
+        reply = read_reply(self.sock)
+        request_id, separator, result = reply.partition(': ')
+        if request_id != str(self.last_id):
+            raise ClamdError(reply)
+        self.last_used = time.monotonic()
+        return result
+
+    def command(self, name):
+        self.send_command(name)
+        return self.read_reply()
+
+    def ping(self):
+        return self.command('PING') == 'PONG'
+
+    def version(self):
+        return self.command('VERSION')
+
+    def instream(self, fileobj, chunk_size=CHUNK_SIZE, timeout=None):
+        self.send_command('INSTREAM')
+        return scan_stream(
+            self.sock,
+            fileobj,
+            lambda: parse_scan_reply(self.read_reply()),
+            chunk_size=chunk_size,
+            timeout=timeout
+        )
+
+    def close(self):
+        try:
+            self.sock.sendall(b'zEND\0')
+        except OSError:
+            pass
+        self.sock.close()
+
+
+# pool of clamd sessions shared by scanning threads, size limits the number of concurrent scans.
+# Sessions idle for more than ping_interval seconds are checked with PING before use,
+# broken ones(e.g. clamd restarted or closed the idle session) are replaced with new ones.
+# Session is closed if a command fails.
+class ClamdPool:
+
+    def __init__(self, clamd=None, size=1, ping_interval=1):
+        self.clamd = clamd
+        self.size = size
+        self.ping_interval = ping_interval
+        self.__idle = collections.deque()
+        self.__lock = threading.Lock()
+        self.__slots = threading.BoundedSemaphore(size)
+
+    def is_alive(self, session):
+        if time.monotonic() - session.last_used < self.ping_interval:
+            return True
+        try:
+            return session.ping()
+        except (OSError, ClamdError):
+            return False
+
+    def acquire(self):
+        self.__slots.acquire()
+        try:
+            while True:
+                with self.__lock:
+                    # most recently used session is the least likely to be closed by clamd
+                    session = self.__idle.pop() if self.__idle else None
+                if session is None:
+                    return self.clamd.session()
+                if self.is_alive(session):
+                    return session
+                session.close()
+        except BaseException:
+            self.__slots.release()
+            raise
+
+    def release(self, session, reuse=True):
+        if reuse:
+            with self.__lock:
+                self.__idle.append(session)
+        else:
+            session.close()
+        self.__slots.release()
+
+    @contextlib.contextmanager
+    def session(self):
+        session = self.acquire()
+        try:
+            yield session
+        except BaseException:
+            self.release(session, reuse=False)
+            raise
+        self.release(session)
+
+    def ping(self):
+        with self.session() as session:
+            return session.ping()
+
+    def version(self):
+        with self.session() as session:
+            return session.version()
+
+    # timed out session is closed, so clamd stops the scan
+    def instream(self, fileobj, chunk_size=CHUNK_SIZE, timeout=None):
+        with self.session() as session:
+            return session.instream(fileobj, chunk_size, timeout)
+
+    # closes idle sessions, sessions in use are kept for later use
+    def close(self):
+        with self.__lock:
+            sessions = list(self.__idle)
+            self.__idle.clear()
+        for session in sessions:
+            session.close()
+
+
+# clamd endpoint of the balancer
+class ClamdEndpoint:
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.name = pool.clamd.name
+        # number of commands running at the moment
+        self.outstanding = 0
+        self.requests = 0
+        # monotonic time of the last connection failure, None if the endpoint is in rotation
+        self.failed = None
+        self.reloading = False
+        # command -> [number of completed commands, total time, max time], seconds
+        self.latency = collections.defaultdict(lambda: [0, 0, 0])
+
+    @property
+    def available(self):
+        return self.failed is None and not self.reloading
+
+
+# spreads commands across clamd endpoints by the least number of outstanding requests.
+# Endpoint is taken out of rotation when it can't be connected and while it reloads definitions,
+# failed endpoint is checked with PING again after retry_interval seconds.
+# If all the endpoints are out of rotation the one which failed the earliest is used.
+class ClamdBalancer:
+
+    def __init__(self, pools=None, retry_interval=5):
+        self.endpoints = [ClamdEndpoint(pool) for pool in pools]
+        self.retry_interval = retry_interval
+        self.__lock = threading.Lock()
+
+    # puts failed endpoints back into rotation if they reply to PING
+    def check_failed(self):
+        now = time.monotonic()
+        with self.__lock:
+            endpoints = [
+                endpoint
+                for endpoint in self.endpoints
+                if endpoint.failed is not None and now - endpoint.failed >= self.retry_interval
+            ]
+            for endpoint in endpoints:
+                # other threads don't check the endpoint at the same time
+                endpoint.failed = now
+        for endpoint in endpoints:
+            try:
+                alive = endpoint.pool.clamd.ping()
+            except (OSError, ClamdError):
+                alive = False
+            if alive:
+                with self.__lock:
+                    endpoint.failed = None
+
+    def acquire(self):
+        self.check_failed()
+        with self.__lock:
+            endpoints = [endpoint for endpoint in self.endpoints if endpoint.available]
+            if not endpoints:
+                endpoints = [min(self.endpoints, key=lambda endpoint: (endpoint.reloading, endpoint.failed or 0))]
+            # endpoint used less often wins a tie
+            endpoint = min(endpoints, key=lambda endpoint: (endpoint.outstanding, endpoint.requests))
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+        return endpoint
+
+    def release(self, endpoint, failed=False):
+        with self.__lock:
+            endpoint.outstanding -= 1
+            if failed:
+                endpoint.failed = time.monotonic()
+
+    # runs the pool method on the chosen endpoint
+    def call(self, method, *args, **kwargs):
+        endpoint = self.acquire()
+        start = time.monotonic()
+        try:
+            result = getattr(endpoint.pool, method)(*args, **kwargs)
+        except ClamdConnectionError:
+            # errors of the scanned file object, e.g. S3 read timeout, don't mean the endpoint is down
+            self.release(endpoint, failed=True)
+            raise
+        except BaseException:
+            self.release(endpoint)
+            raise
+        elapsed = time.monotonic() - start
+        with self.__lock:
+            latency = endpoint.latency[method]
+            latency[0] += 1
+            latency[1] += elapsed
+            latency[2] = max(latency[2], elapsed)
+        self.release(endpoint)
+        return result
+
+    def ping(self):
+        return self.call('ping')
+
+    def version(self):
+        return self.call('version')
+
+    def instream(self, fileobj, chunk_size=CHUNK_SIZE, timeout=None):
+        return self.call('instream', fileobj, chunk_size, timeout)
+
+    # endpoints with the names are out of rotation while they reload definitions, the rest are back.
+    # clamd is reloaded by another process, e.g. virus definitions updater
+    def set_reloading(self, names):
+        with self.__lock:
+            for endpoint in self.endpoints:
+                endpoint.reloading = endpoint.name in names
+
+    # endpoint name -> state and commands latency in seconds
+    def get_stats(self):
+        with self.__lock:
+            return {
+                endpoint.name: dict(
+                    available=endpoint.available,
+                    outstanding=endpoint.outstanding,
+                    requests=endpoint.requests,
+                    latency={
+                        method: dict(count=count, mean=total / count, max=maximum)
+                        for method, (count, total, maximum) in endpoint.latency.items()
+                    }
+                )
+                for endpoint in self.endpoints
+            }
+
+    def close(self):
+        for endpoint in self.endpoints:
+            endpoint.pool.close()
@@ -0,0 +1,116 @@
+import os
+import threading
+import boto3
+from botocore.config import Config
+
+
+# boto3 clients settings shared by all the DAOs
+AWS_MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', 50))
+AWS_TCP_KEEPALIVE = os.environ.get('AWS_TCP_KEEPALIVE', 'true').lower() == 'true'
+AWS_RETRY_MODE = os.environ.get('AWS_RETRY_MODE', 'adaptive')
+AWS_MAX_ATTEMPTS = int(os.environ.get('AWS_MAX_ATTEMPTS', 5))
+AWS_CONNECT_TIMEOUT = int(os.environ.get('AWS_CONNECT_TIMEOUT', 5))
+# must be longer than SQS long polling wait time
+AWS_READ_TIMEOUT = int(os.environ.get('AWS_READ_TIMEOUT', 60))
+
+
+def get_client_config():
+    return Config(
+        max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+        tcp_keepalive=AWS_TCP_KEEPALIVE,
+        retries=dict(
+            mode=AWS_RETRY_MODE,
+            max_attempts=AWS_MAX_ATTEMPTS
+        ),
+        connect_timeout=AWS_CONNECT_TIMEOUT,
+        read_timeout=AWS_READ_TIMEOUT
+    )
+
+
+# sessions by credentials, clients and resource classes by service and connection parameters.
+# Clients are thread safe and shared by all the DAOs and threads of the process.
+# Resources are not thread safe, get_resource creates a new one on top of the shared client.
+_sessions = dict()
+_clients = dict()
+_resource_classes = dict()
+_lock = threading.Lock()
+
+
+def clear_connections():
+    global _lock
+    _sessions.clear()
+    _clients.clear()
+    _resource_classes.clear()
+    _lock = threading.Lock()
+
+
+# connection pools must not be shared with forked worker processes
+os.register_at_fork(after_in_child=clear_connections)
+
+
+def get_session(aws_access_key_id=None, aws_secret_access_key=None, region_name=None):
+    key = (aws_access_key_id, aws_secret_access_key, region_name)
+    with _lock:
+        try:
+            return _sessions[key]
+        except KeyError:
+            session = _sessions[key] = boto3.session.Session(
+                aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+                region_name=region_name
+            )
+            return session
+
+
+def get_client(service, endpoint_url=None, **connection_conf):
+    session = get_session(**connection_conf)
+    key = (service, endpoint_url, *sorted(connection_conf.items()))
+    with _lock:
+        try:
+            return _clients[key]
+        except KeyError:
+            client = _clients[key] = session.client(
+                service,
+                endpoint_url=endpoint_url,
+                config=get_client_config()
+            )
+            return client
+
+
+# returns a new resource using the shared client, the resource must not be shared between threads
+def get_resource(service, endpoint_url=None, **connection_conf):
+    client = get_client(service, endpoint_url=endpoint_url, **connection_conf)
+    session = get_session(**connection_conf)
+    key = (service, endpoint_url, *sorted(connection_conf.items()))
+    with _lock:
+        try:
+            cls = _resource_classes[key]
+        except KeyError:
+            # resource class is generated from the service model once
+            cls = _resource_classes[key] = session.resource(
+                service,
+                endpoint_url=endpoint_url,
+                config=get_client_config()
+            ).__class__
+    return cls(client=client)
+
+
+# property evaluated once per thread and instance. boto3 resources are not thread safe,
+# DAOs keep them in such properties, so each thread gets its own ones sharing the client
+class thread_local_property:
+
+    def __init__(self, getter):
+        self.getter = getter
+        self.name = getter.__name__
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        # setdefault is atomic, threads racing for the first access get the same storage
+        local = instance.__dict__.setdefault('_thread_local_properties', threading.local())
+        try:
+            return getattr(local, self.name)
+        except AttributeError:
+            value = self.getter(instance)
+            setattr(local, self.name, value)
+            return value
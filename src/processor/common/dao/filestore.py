@@ -1,15 +1,55 @@
 import os
+import time
 import posixpath
-import boto3
+import collections
+from concurrent import futures
 from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig, ProgressCallbackInvoker, create_transfer_manager
 # from common import loggers
 from . import utils
+from .connections import get_resource, thread_local_property
+
+
+# size of chunks written to disk during the download, bytes
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# objects larger than this are transferred in parts of this size, bytes
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+# number of objects transferred in parallel by recursive download
+MAX_TRANSFER_WORKERS = 10
+# recursive download submits up to this number of objects per transfer worker ahead of the completed ones
+TRANSFER_QUEUE_FACTOR = 4
+# number of DeleteObjects calls running in parallel by recursive delete, each one deletes up to 1000 keys
+MAX_DELETE_WORKERS = 4
+
+
+# recursive transfer results
+TransferStats = collections.namedtuple('TransferStats', ['files', 'bytes', 'seconds'])
+# object metadata from the listing
+ObjectSummary = collections.namedtuple('ObjectSummary', ['key', 'size', 'etag', 'last_modified'])
+
+
+# settings shared by all the objects of a transfer, max_concurrency limits the number of transfer threads
+def get_transfer_config(max_concurrency=MAX_TRANSFER_WORKERS, part_size=MULTIPART_CHUNK_SIZE):
+    return TransferConfig(
+        multipart_threshold=max(MULTIPART_THRESHOLD, part_size),
+        multipart_chunksize=part_size,
+        max_concurrency=max_concurrency
+    )
 
 
 class FileChangedError(Exception):
     pass
 
 
+class FileTooLargeError(Exception):
+    pass
+
+
+class DeleteError(Exception):
+    pass
+
+
 def is_precondition_failed_error(e):
     code = e.response['Error']['Code']
     return code in ['PreconditionFailed', '412']
@@ -18,17 +58,20 @@ def is_precondition_failed_error(e):
 class FileStore:
 
     def __init__(self, bucket=None, connection_conf=None):
-        self.s3 = boto3.resource('s3', **connection_conf)
-        self.exceptions = self.s3.meta.client.exceptions
+        self.__connection_conf = connection_conf
         self.__bucket_name = bucket
 
     @property
+    def exceptions(self):
+        return self.s3.meta.client.exceptions
+
+    @thread_local_property
+    def s3(self):
+        return get_resource('s3', **self.__connection_conf)
+
+    @thread_local_property
     def bucket(self):
-        try:
-            return self.__bucket
-        except AttributeError:
-            self.__bucket = self.s3.Bucket(self.__bucket_name)
-            return self.__bucket
+        return self.s3.Bucket(self.__bucket_name)
 
     def get(
         self,
@@ -50,6 +93,39 @@ class FileStore:
                 return None
             raise  # pragma: no cover
 
+    # returns object metadata without the body, None if the object doesn't exist or etag doesn't match
+    def head(
+        self,
+        key=None,
+        etag=None
+    ):
+        params = utils.to_aws_params(
+            Bucket=self.bucket.name,
+            Key=key,
+            IfMatch=etag
+        )
+        try:
+            return self.s3.meta.client.head_object(**params)
+        except ClientError as e:
+            # HEAD responses have no body, so there are only status codes
+            if e.response['Error']['Code'] in ['404', 'NoSuchKey'] or is_precondition_failed_error(e):
+                return None
+            raise  # pragma: no cover
+
+    # returns object body stream, the caller must close it
+    def stream(
+        self,
+        key=None,
+        etag=None
+    ):
+        response = self.get(
+            key=key,
+            etag=etag
+        )
+        if response is None:
+            raise FileChangedError()
+        return response['Body']
+
     def post(self, key=None, body=None):
         object = self.bucket.Object(key=key)
         object.put(
@@ -57,34 +133,57 @@ class FileStore:
         )
         return True
 
+    # streams fileobj or the file at path to the object, objects larger than the part size are uploaded in parts
+    # in parallel. Parts of the file at path are read from disk when they are sent, parts of fileobj are buffered.
+    # Part size is increased if the object would have more than 10000 parts.
+    # Incomplete multipart upload is aborted on failure. Returns TransferStats
+    def upload(
+        self,
+        key=None,
+        fileobj=None,
+        path=None,
+        part_size=MULTIPART_CHUNK_SIZE,
+        max_workers=MAX_TRANSFER_WORKERS
+    ):
+        start_time = time.monotonic()
+        progress = []
+        with create_transfer_manager(self.s3.meta.client, get_transfer_config(max_workers, part_size)) as manager:
+            future = manager.upload(
+                fileobj=fileobj if path is None else path,
+                bucket=self.bucket.name,
+                key=key,
+                subscribers=[ProgressCallbackInvoker(progress.append)]
+            )
+            future.result()
+        return TransferStats(1, sum(progress), time.monotonic() - start_time)
+
     def download(
         self,
         path=None,
         key=None,
         recursive=False,
-        etag=None
+        etag=None,
+        hasher=None,
+        callback=None,
+        max_size=None,
+        max_workers=MAX_TRANSFER_WORKERS,
+        retries=3
     ):
+        # non recursive download is written in chunks, hasher(e.g. hashlib.sha256()) is updated with each chunk
+        # and callback is called with the number of bytes written.
+        # FileTooLargeError is raised as soon as more than max_size bytes are received, partial file is removed.
+        # Recursive download returns TransferStats
         if recursive:
             if not os.path.isdir(path):
                 raise ValueError('Recursive path must be dir')
             if key and not key.endswith('/'):
                 raise ValueError(f'Recursive key prefix must end with /. Key:{key}')
-            objects = self.bucket.objects.filter(
-                Prefix=key
+            return self.download_recursive(
+                path=path,
+                key=key,
+                max_workers=max_workers,
+                retries=retries
             )
-            downloaded = 0
-            for summary in objects:
-                object = summary.Object()
-                filename = os.path.join(
-                    path,
-                    posixpath.relpath(summary.key, key)
-                )
-                os.makedirs(os.path.dirname(filename), exist_ok=True)
-                object.download_file(
-                    Filename=filename
-                )
-                downloaded += 1
-            return downloaded
         else:
             response = self.get(
                 key=key,
@@ -92,10 +191,83 @@ class FileStore:
             )
             if response is None:
                 raise FileChangedError()
-            with open(path, 'wb') as f:
-                f.write(response['Body'].read())
+            body = response['Body']
+            size = 0
+            try:
+                with open(path, 'wb') as f:
+                    for chunk in body.iter_chunks(DOWNLOAD_CHUNK_SIZE):
+                        size += len(chunk)
+                        if max_size is not None and size > max_size:
+                            raise FileTooLargeError(f'File {key} is larger than {max_size} bytes')
+                        f.write(chunk)
+                        if hasher is not None:
+                            hasher.update(chunk)
+                        if callback is not None:
+                            callback(len(chunk))
+            except BaseException:
+                body.close()
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                raise
             return 1
 
+    # downloads objects in max_workers threads while they are listed,
+    # failed object downloads are retried up to retries times.
+    # Listing waits for completed downloads, so pending downloads of a large prefix are not kept in memory
+    def download_recursive(
+        self,
+        path=None,
+        key=None,
+        max_workers=MAX_TRANSFER_WORKERS,
+        retries=3
+    ):
+        start_time = time.monotonic()
+        created_dirs = set()
+        files = 0
+        size = 0
+        with create_transfer_manager(self.s3.meta.client, get_transfer_config(max_workers)) as manager:
+
+            def submit(summary, attempt=0):
+                filename = os.path.join(
+                    path,
+                    posixpath.relpath(summary.key, key)
+                )
+                dirname = os.path.dirname(filename)
+                if dirname not in created_dirs:
+                    os.makedirs(dirname, exist_ok=True)
+                    created_dirs.add(dirname)
+                future = manager.download(
+                    bucket=self.bucket.name,
+                    key=summary.key,
+                    fileobj=filename
+                )
+                return (future, summary, attempt)
+
+            def complete():
+                nonlocal files, size
+                future, summary, attempt = transfers.popleft()
+                try:
+                    future.result()
+                except Exception:
+                    if attempt >= retries:
+                        raise
+                    transfers.append(submit(summary, attempt + 1))
+                    return
+                files += 1
+                size += summary.size
+
+            # downloads are running while next pages are listed
+            transfers = collections.deque()
+            for summary in self.bucket.objects.filter(Prefix=key):
+                while len(transfers) >= max_workers * TRANSFER_QUEUE_FACTOR:
+                    complete()
+                transfers.append(submit(summary))
+            while transfers:
+                complete()
+        return TransferStats(files, size, time.monotonic() - start_time)
+
     def copy(
         self,
         key=None,
@@ -142,23 +314,84 @@ class FileStore:
         self,
         key=None,
         etag=None,
-        recursive=False
+        recursive=False,
+        max_workers=MAX_DELETE_WORKERS,
+        retries=3
     ):
         if recursive:
-            objects = self.bucket.objects.filter(
-                Prefix=key
+            return self.delete_recursive(
+                key=key,
+                max_workers=max_workers,
+                retries=retries
             )
-            deleted = 0
-            for summary in objects:
-                summary.Object().delete()
-                deleted += 1
-            return deleted
         object = self.bucket.Object(key=key)
         if etag is not None and object.e_tag != etag:
             raise FileChangedError()
         object.delete()
         return 1
 
+    # deletes objects page by page while next pages are listed, max_workers pages at once.
+    # Returns the number of deleted objects
+    def delete_recursive(
+        self,
+        key=None,
+        max_workers=MAX_DELETE_WORKERS,
+        retries=3
+    ):
+        deleted = 0
+        in_flight = set()
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # list page contains up to 1000 keys, that's DeleteObjects limit
+            for page in self.bucket.objects.filter(Prefix=key).pages():
+                if len(in_flight) >= max_workers:
+                    done, in_flight = futures.wait(in_flight, return_when=futures.FIRST_COMPLETED)
+                    deleted += sum(future.result() for future in done)
+                keys = [summary.key for summary in page]
+                if keys:
+                    in_flight.add(executor.submit(self.delete_many, keys, retries))
+            deleted += sum(future.result() for future in futures.as_completed(in_flight))
+        return deleted
+
+    # deletes up to 1000 keys in one request, keys failed to be deleted are retried up to retries times.
+    # Returns the number of deleted objects
+    def delete_many(self, keys=None, retries=3):
+        deleted = 0
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(0.1 * 2 ** (attempt - 1))
+            response = self.bucket.delete_objects(
+                Delete=dict(
+                    Objects=[dict(Key=key) for key in keys],
+                    # only errors are returned
+                    Quiet=True
+                )
+            )
+            errors = response.get('Errors', [])
+            deleted += len(keys) - len(errors)
+            keys = [error['Key'] for error in errors]
+            if not keys:
+                return deleted
+        raise DeleteError(
+            f'Failed to delete {len(errors)} objects. '
+            f'First error: {errors[0].get("Key")} {errors[0].get("Code")} {errors[0].get("Message")}'
+        )
+
+    # yields ObjectSummary of each object, no requests are made per object
+    def list_objects(self, key=None):
+        paginator = self.s3.meta.client.get_paginator('list_objects_v2')
+        params = utils.to_aws_params(
+            Bucket=self.bucket.name,
+            Prefix=key
+        )
+        for page in paginator.paginate(**params):
+            for item in page.get('Contents', []):
+                yield ObjectSummary(
+                    key=item['Key'],
+                    size=item['Size'],
+                    etag=item['ETag'],
+                    last_modified=item['LastModified']
+                )
+
     def list(self, key=None):
         if key:
             def filtered_gen():
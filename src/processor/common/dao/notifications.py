@@ -1,5 +1,5 @@
 import json
-import boto3
+from .connections import get_resource, thread_local_property
 
 
 class Notifications:
@@ -9,16 +9,16 @@ class Notifications:
         topic=None,
         connection_conf=None
     ):
-        self.sns = boto3.resource('sns', **connection_conf)
+        self.__connection_conf = connection_conf
         self.__topic_name = topic
 
-    @property
+    @thread_local_property
+    def sns(self):
+        return get_resource('sns', **self.__connection_conf)
+
+    @thread_local_property
     def topic(self):
-        try:
-            return self.__topic
-        except AttributeError:
-            self.__topic = self.sns.Topic(self.__topic_name)
-            return self.__topic
+        return self.sns.Topic(self.__topic_name)
 
     def post(
         self,
@@ -1,5 +1,18 @@
-import boto3
+import time
+import threading
+from concurrent import futures
 from . import utils
+from .connections import get_resource, thread_local_property
+
+
+# SQS limit for the number of entries in batch actions
+MAX_BATCH_SIZE = 10
+# SQS limit for the total size of messages sent in one batch, bytes
+MAX_BATCH_PAYLOAD_SIZE = 256 * 1024
+
+
+class SendError(Exception):
+    pass
 
 
 class Message:
@@ -9,6 +22,10 @@ class Message:
         self.body = message_res.body
         self.receipt_handle = message_res.receipt_handle
         self.attributes = message_res.message_attributes
+        # number of times the message was received, including this one
+        self.receive_count = int((message_res.attributes or {}).get('ApproximateReceiveCount', 1))
+        # monotonic clock time the message was received at
+        self.received = time.monotonic()
 
 
 class Queue:
@@ -18,36 +35,63 @@ class Queue:
         queue=None,
         connection_conf=None
     ):
-        self.sqs = boto3.resource('sqs', **connection_conf)
-        self.exceptions = self.sqs.meta.client.exceptions
+        self.__connection_conf = connection_conf
         self.__queue_name = queue
+        self.__queue_url = None
+
+    @property
+    def name(self):
+        return self.__queue_name
 
     @property
+    def exceptions(self):
+        return self.sqs.meta.client.exceptions
+
+    @thread_local_property
+    def sqs(self):
+        return get_resource('sqs', **self.__connection_conf)
+
+    @thread_local_property
     def queue(self):
-        try:
-            return self.__queue
-        except AttributeError:
-            self.__queue = self.sqs.get_queue_by_name(
+        # queue url is resolved once
+        if self.__queue_url is None:
+            self.__queue_url = self.sqs.get_queue_by_name(
                 QueueName=self.__queue_name
-            )
-            return self.__queue
+            ).url
+        return self.sqs.Queue(self.__queue_url)
 
     def get(
         self,
         visibility_timeout=None,
         wait_time=None
     ):
+        messages = self.get_many(
+            max_messages=1,
+            visibility_timeout=visibility_timeout,
+            wait_time=wait_time
+        )
+        if messages:
+            return messages[0]
+        return None
+
+    def get_many(
+        self,
+        max_messages=MAX_BATCH_SIZE,
+        visibility_timeout=None,
+        wait_time=None
+    ):
+        if not 1 <= max_messages <= MAX_BATCH_SIZE:
+            raise ValueError(f'max_messages must be between 1 and {MAX_BATCH_SIZE}. Got:{max_messages}')
         params = utils.to_aws_params(
             VisibilityTimeout=visibility_timeout,
             WaitTimeSeconds=wait_time
         )
         messages = self.queue.receive_messages(
-            MaxNumberOfMessages=1,
+            MaxNumberOfMessages=max_messages,
+            AttributeNames=['ApproximateReceiveCount'],
             **params
         )
-        if messages:
-            return Message(messages[0])
-        return None
+        return [Message(message) for message in messages]
 
     def post(
         self,
@@ -66,6 +110,58 @@ class Queue:
         )
         self.queue.send_message(**params)
 
+    # sends messages using send_message_batch, each message is a dict of post arguments.
+    # Entries failed because of SQS side errors are resent up to retries times.
+    # Returns (message, failed entry) pairs which were not sent
+    def post_many(self, messages=None, retries=3):
+        failed = []
+        for batch in self.split_batches(messages):
+            for attempt in range(retries + 1):
+                if attempt:
+                    time.sleep(0.1 * 2 ** (attempt - 1))
+                response = self.queue.send_messages(
+                    Entries=[
+                        dict(
+                            Id=str(index),
+                            **utils.to_aws_params(
+                                MessageBody=message.get('body'),
+                                DelaySeconds=message.get('delay'),
+                                MessageAttributes=message.get('attributes'),
+                                MessageDeduplicationId=message.get('deduplication_id'),
+                                MessageGroupId=message.get('group_id')
+                            )
+                        )
+                        for index, message in enumerate(batch)
+                    ]
+                )
+                retry = []
+                for entry in response.get('Failed', []):
+                    message = batch[int(entry['Id'])]
+                    # sender faults, e.g. invalid parameters, will fail again
+                    if entry.get('SenderFault') or attempt == retries:
+                        failed.append((message, entry))
+                    else:
+                        retry.append(message)
+                batch = retry
+                if not batch:
+                    break
+        return failed
+
+    # splits messages into batches within SQS entries number and payload size limits
+    def split_batches(self, messages):
+        batch = []
+        batch_size = 0
+        for message in messages:
+            size = get_message_size(message)
+            if batch and (len(batch) == MAX_BATCH_SIZE or batch_size + size > MAX_BATCH_PAYLOAD_SIZE):
+                yield batch
+                batch = []
+                batch_size = 0
+            batch.append(message)
+            batch_size += size
+        if batch:
+            yield batch
+
     def delete(
         self,
         message=None,
@@ -85,3 +181,139 @@ class Queue:
         )
         # always true for some reason, maybe elasticmq issue
         return len(response['Successful']) != 0
+
+    # returns (message, failed entry) pairs which were not deleted,
+    # such messages become visible again once their visibility timeout expires
+    def delete_many(self, messages=None):
+        failed = []
+        for start in range(0, len(messages), MAX_BATCH_SIZE):
+            batch = messages[start:start + MAX_BATCH_SIZE]
+            # batch entry ids must be unique only within the request
+            response = self.queue.delete_messages(
+                Entries=[
+                    dict(
+                        ReceiptHandle=message.receipt_handle,
+                        Id=str(index)
+                    )
+                    for index, message in enumerate(batch)
+                ]
+            )
+            for entry in response.get('Failed', []):
+                failed.append((batch[int(entry['Id'])], entry))
+        return failed
+
+    # returns (message, failed entry) pairs which visibility timeout wasn't changed
+    def change_visibility_many(self, messages=None, timeout=None):
+        failed = []
+        for start in range(0, len(messages), MAX_BATCH_SIZE):
+            batch = messages[start:start + MAX_BATCH_SIZE]
+            response = self.queue.change_message_visibility_batch(
+                Entries=[
+                    dict(
+                        ReceiptHandle=message.receipt_handle,
+                        VisibilityTimeout=timeout,
+                        Id=str(index)
+                    )
+                    for index, message in enumerate(batch)
+                ]
+            )
+            for entry in response.get('Failed', []):
+                failed.append((batch[int(entry['Id'])], entry))
+        return failed
+
+
+def get_message_size(message):
+    size = len(message['body'].encode())
+    for name, attribute in (message.get('attributes') or {}).items():
+        size += len(name.encode()) + len(attribute.get('DataType', '').encode())
+        value = attribute.get('StringValue', attribute.get('BinaryValue', ''))
+        size += len(value.encode() if isinstance(value, str) else value)
+    return size
+
+
+# buffers posted messages and sends them in batches from a background thread.
+# A batch is sent once it has MAX_BATCH_SIZE messages or max_wait seconds after its first message.
+# post returns a future which is resolved once the message is sent, SendError is raised if it was not.
+# post blocks while max_buffered_batches full batches are waiting to be sent.
+class BatchSender:
+
+    def __init__(self, queue=None, max_wait=0.05, retries=3, max_buffered_batches=10):
+        self.queue = queue
+        self.max_wait = max_wait
+        self.retries = retries
+        self.max_buffered_batches = max_buffered_batches
+        # (message, future) pairs
+        self.__buffer = []
+        self.__condition = threading.Condition()
+        self.__thread = None
+        self.__closed = False
+
+    def post(self, **message):
+        future = futures.Future()
+        with self.__condition:
+            while len(self.__buffer) >= self.max_buffered_batches * MAX_BATCH_SIZE and not self.__closed:
+                self.__condition.wait()
+            if self.__closed:
+                future.set_exception(SendError('Sender is closed'))
+                return future
+            self.__buffer.append((message, future))
+            if self.__thread is None:
+                self.__thread = threading.Thread(
+                    target=self.run,
+                    name=self.__class__.__name__,
+                    daemon=True
+                )
+                self.__thread.start()
+            # posts waiting for the buffer space share the condition with the sender thread
+            self.__condition.notify_all()
+        return future
+
+    def run(self):
+        while True:
+            with self.__condition:
+                while not self.__buffer and not self.__closed:
+                    self.__condition.wait()
+                if not self.__buffer:
+                    return
+                deadline = time.monotonic() + self.max_wait
+                while len(self.__buffer) < MAX_BATCH_SIZE and not self.__closed:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self.__condition.wait(timeout)
+                batch = self.__buffer[:MAX_BATCH_SIZE]
+                del self.__buffer[:MAX_BATCH_SIZE]
+                self.__condition.notify_all()
+            self.send(batch)
+
+    def send(self, batch):
+        try:
+            failed = self.queue.post_many(
+                messages=[message for message, future in batch],
+                retries=self.retries
+            )
+        except Exception as e:
+            for message, future in batch:
+                future.set_exception(e)
+            return
+        # messages are dicts created by post, identity is used to find their futures
+        errors = {id(message): entry for message, entry in failed}
+        for message, future in batch:
+            entry = errors.get(id(message))
+            if entry is None:
+                future.set_result(True)
+            else:
+                future.set_exception(SendError(f'{entry.get("Code")}: {entry.get("Message")}'))
+
+    # sends buffered messages and stops the sender thread,
+    # the thread is started again by the next post
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+            thread = self.__thread
+        if thread is not None:
+            thread.join()
+        with self.__condition:
+            self.__closed = False
+            self.__thread = None
@@ -0,0 +1,81 @@
+import os
+import time
+import uuid
+import shutil
+import tempfile
+import threading
+
+
+class ScratchSpaceExhausted(Exception):
+    pass
+
+
+# unique temporary files of the process within a disk space budget.
+# Files are created in a private directory inside dir, e.g. tmpfs mounted /dev/shm,
+# so processes sharing dir don't overwrite each other's files.
+class ScratchSpace:
+
+    def __init__(self, dir=None, budget=0, timeout=60, prefix='scratch-'):
+        self.dir = dir or tempfile.gettempdir()
+        # max total size of reserved files in bytes, 0 means no limit
+        self.budget = budget
+        # max time in seconds to wait for the budget
+        self.timeout = timeout
+        self.prefix = prefix
+        # path -> reserved size
+        self.__reserved = dict()
+        self.__condition = threading.Condition()
+        self.__path = None
+
+    @property
+    def path(self):
+        with self.__condition:
+            if self.__path is None or not os.path.isdir(self.__path):
+                self.__path = tempfile.mkdtemp(prefix=self.prefix, dir=self.dir)
+            return self.__path
+
+    @property
+    def reserved(self):
+        with self.__condition:
+            return sum(self.__reserved.values())
+
+    def fits(self, size):
+        # file larger than the whole budget can use it alone
+        reserved = sum(self.__reserved.values())
+        return not self.budget or not reserved or reserved + size <= self.budget
+
+    # returns a new file path with size bytes reserved for it,
+    # waits until other files are released if the budget is exhausted
+    def reserve(self, size=0):
+        path = os.path.join(self.path, uuid.uuid4().hex)
+        deadline = time.monotonic() + self.timeout
+        with self.__condition:
+            while not self.fits(size):
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    raise ScratchSpaceExhausted(
+                        f'Failed to reserve {size} bytes in {self.timeout} seconds. '
+                        f'Reserved: {sum(self.__reserved.values())}. Budget: {self.budget}'
+                    )
+                self.__condition.wait(timeout)
+            self.__reserved[path] = size
+        return path
+
+    # removes the file and releases its reservation
+    def release(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        with self.__condition:
+            self.__reserved.pop(path, None)
+            self.__condition.notify_all()
+
+    # removes the private directory with all the files in it
+    def close(self):
+        with self.__condition:
+            path, self.__path = self.__path, None
+            self.__reserved.clear()
+            self.__condition.notify_all()
+        if path is not None:
+            shutil.rmtree(path, ignore_errors=True)
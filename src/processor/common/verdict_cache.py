@@ -0,0 +1,67 @@
+import json
+import threading
+import collections
+
+
+# verdict of a clean file, infected files verdict is the signature name
+CLEAN = 'OK'
+
+
+# scan verdicts by (file content SHA-256, virus definitions version).
+# Recently used verdicts are kept in memory, filestore is an optional persistent tier shared by all the scanners.
+# Memory tier is cleared when definitions version changes, persistent tier keys are prefixed by the version.
+class VerdictCache:
+
+    def __init__(self, size=10000, filestore=None):
+        self.size = size
+        self.filestore = filestore
+        self.version = None
+        # (sha256, version) -> verdict
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get_key(self, sha256, version):
+        return f'{version}/{sha256}'
+
+    def set_version(self, version):
+        with self.__lock:
+            if version != self.version:
+                self.__entries.clear()
+                self.version = version
+
+    def remember(self, sha256, version, verdict):
+        self.set_version(version)
+        with self.__lock:
+            self.__entries[(sha256, version)] = verdict
+            self.__entries.move_to_end((sha256, version))
+            while len(self.__entries) > self.size:
+                self.__entries.popitem(last=False)
+
+    def get(self, sha256, version):
+        self.set_version(version)
+        with self.__lock:
+            try:
+                self.__entries.move_to_end((sha256, version))
+                return self.__entries[(sha256, version)]
+            except KeyError:
+                pass
+        if self.filestore is None:
+            return None
+        fileobj = self.filestore.get(key=self.get_key(sha256, version))
+        if fileobj is None:
+            return None
+        verdict = json.loads(fileobj['Body'].read())['verdict']
+        self.remember(sha256, version, verdict)
+        return verdict
+
+    def put(self, sha256, version, verdict):
+        self.remember(sha256, version, verdict)
+        if self.filestore is not None:
+            self.filestore.post(
+                key=self.get_key(sha256, version),
+                body=json.dumps(dict(
+                    sha256=sha256,
+                    version=version,
+                    verdict=verdict
+                ))
+            )
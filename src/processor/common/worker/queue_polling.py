@@ -1,5 +1,14 @@
 import os
+import json
+import time
+import random
+import signal
+import resource
 import datetime
+import functools
+import threading
+import collections
+from concurrent import futures
 from common import loggers
 
 
@@ -10,39 +19,506 @@ class QueuePollingWorker:
 
     MESSAGE_WAIT_TIME = 0
     MESSAGE_VISIBILITY_TIMEOUT = 0
+    # number of messages received per call, 1..10
+    MESSAGE_BATCH_SIZE = 1
+    # number of messages processed at the same time, each one in its own thread.
+    # 1 means messages are processed in the polling thread.
+    CONCURRENCY = 1
+    # limit of received but not yet processed messages,
+    # defaults to the largest of CONCURRENCY and MESSAGE_BATCH_SIZE
+    MAX_IN_FLIGHT_MESSAGES = None
+    # number of messages prepared by prefetch_message in background threads ahead of processing.
+    # Prefetched messages are in flight, so they should be kept invisible by the heartbeat. 0 disables prefetching.
+    PREFETCH_DEPTH = 0
+    # while a message is processed its visibility timeout is extended by MESSAGE_VISIBILITY_TIMEOUT
+    # every MESSAGE_HEARTBEAT_INTERVAL seconds. 0 disables the heartbeat.
+    # When the heartbeat is enabled failed messages are released(become visible) right away.
+    # The interval must be less than MESSAGE_VISIBILITY_TIMEOUT, otherwise messages become visible before the extension
+    MESSAGE_HEARTBEAT_INTERVAL = 0
+    # SQS does not allow to keep a message invisible for longer than 12 hours since it was received
+    MESSAGE_MAX_VISIBILITY_TIMEOUT = 12 * 60 * 60
+    # empty queue polling: after an empty receive the next one uses long polling with MESSAGE_IDLE_WAIT_TIME,
+    # after IDLE_BACKOFF_THRESHOLD empty receives in a row the worker also sleeps before the next receive.
+    # Sleep time grows exponentially from IDLE_BACKOFF_BASE up to IDLE_BACKOFF_MAX seconds, full jitter applied.
+    # The first received message switches the worker back to MESSAGE_WAIT_TIME polling.
+    MESSAGE_IDLE_WAIT_TIME = 20
+    IDLE_BACKOFF_THRESHOLD = 3
+    IDLE_BACKOFF_BASE = 1
+    IDLE_BACKOFF_MAX = 60
+    # while messages are in flight receives don't wait for new messages.
+    # If nothing was received the worker waits up to max(MESSAGE_WAIT_TIME, IN_FLIGHT_WAIT_TIME) seconds
+    # for a message to complete before the next receive, so a busy worker doesn't poll an empty queue in a loop
+    IN_FLIGHT_WAIT_TIME = 1
+    # worker stops after receiving MAX_MESSAGES messages or when its peak memory usage
+    # exceeds MAX_MEMORY megabytes. Used to recycle supervised worker processes. 0 means no limit.
+    MAX_MESSAGES = 0
+    MAX_MEMORY = 0
+    # on SIGTERM/SIGINT worker stops receiving and waits up to SHUTDOWN_TIMEOUT seconds
+    # for in flight messages, unfinished messages are released
+    SHUTDOWN_TIMEOUT = 20
+    # failed messages become visible again after MESSAGE_RETRY_BACKOFF_BASE * 2 ** (receive count - 1) seconds,
+    # up to MESSAGE_RETRY_BACKOFF_MAX seconds. 0 disables the backoff: with the heartbeat enabled
+    # failed messages are released right away, otherwise they wait for their visibility timeout.
+    MESSAGE_RETRY_BACKOFF_BASE = 0
+    MESSAGE_RETRY_BACKOFF_MAX = 60 * 60
+    # failed messages received MESSAGE_MAX_RECEIVE_COUNT times are moved to the parking queue
+    # along with the failure reason instead of being retried. 0 or no parking queue means no limit.
+    MESSAGE_MAX_RECEIVE_COUNT = 0
 
-    def __init__(self, queue_dao=None, logger=None):
+    def __init__(self, queue_dao=None, logger=None, parking_queue_dao=None):
+        if self.MESSAGE_HEARTBEAT_INTERVAL and self.MESSAGE_HEARTBEAT_INTERVAL >= self.MESSAGE_VISIBILITY_TIMEOUT:
+            raise ValueError(
+                f'Message heartbeat interval {self.MESSAGE_HEARTBEAT_INTERVAL} must be less than '
+                f'visibility timeout {self.MESSAGE_VISIBILITY_TIMEOUT}'
+            )
         self.__queue = queue_dao
+        self.__parking_queue = parking_queue_dao
         self.logger = logger if logger else queue_polling_worker_logger
+        self.__executor = None
+        self.__prefetch_executor = None
+        # future -> message
+        self.__in_flight = dict()
+        # message -> prefetch future
+        self.__prefetched = dict()
+        # messages waiting for delete/release
+        self.__processed = []
+        self.__failed = []
+        # message -> failure reason
+        self.__failure_reasons = dict()
+        # message -> (received time, visibility timeout end time), monotonic clock
+        self.__heartbeat_messages = dict()
+        self.__heartbeat_lock = threading.Lock()
+        self.__heartbeat_stop = threading.Event()
+        self.__heartbeat_thread = None
+        self.consecutive_empty_receives = 0
+        self.stats = collections.Counter()
+        self.stopping = threading.Event()
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        self.logger.info(
-            'Getting message. Wait time: %s seconds. Visibility Timeout: %s seconds',
-            self.MESSAGE_WAIT_TIME,
+        if len(self.__in_flight) >= self.max_in_flight_messages:
+            self.wait_in_flight_messages(return_when=futures.FIRST_COMPLETED)
+        batch_size = min(
+            self.MESSAGE_BATCH_SIZE,
+            self.max_in_flight_messages - len(self.__in_flight)
+        )
+        busy = bool(self.__in_flight)
+        if busy:
+            # messages being processed must be acknowledged without waiting for the long polling
+            wait_time = 0
+        else:
+            self.idle_backoff()
+            wait_time = self.get_wait_time()
+        self.logger.debug(
+            'Getting messages. Batch size: %s. Wait time: %s seconds. Visibility Timeout: %s seconds',
+            batch_size,
+            wait_time,
             self.MESSAGE_VISIBILITY_TIMEOUT
         )
-        message = self.__queue.get(
-            wait_time=self.MESSAGE_WAIT_TIME,
+        messages = self.__queue.get_many(
+            max_messages=batch_size,
+            wait_time=wait_time,
             visibility_timeout=self.MESSAGE_VISIBILITY_TIMEOUT
         )
+        self.stats['receives'] += 1
+        if messages:
+            self.consecutive_empty_receives = 0
+            self.stats['messages_received'] += len(messages)
+        else:
+            # only idle receives count, an empty receive of a busy worker doesn't mean the queue is idle
+            if not busy:
+                self.consecutive_empty_receives += 1
+            self.stats['empty_receives'] += 1
+            self.logger.debug(
+                'No messages received. Empty receives in a row: %s. Total: %s',
+                self.consecutive_empty_receives,
+                self.stats['empty_receives']
+            )
+        if messages and self.stopping.is_set():
+            # stop signal received during the long polling
+            self.logger.info('Worker is stopping, releasing %s received messages', len(messages))
+            self.stats['messages_released'] += len(messages)
+            self.release_messages(messages)
+            return True
+        self.start_heartbeat(messages)
 
-        if message is not None:
+        for index, message in enumerate(messages):
             self.logger.info('Message received:%s', message.id)
             # self.logger.info(message.body)
-            if self.process_message(message):
-                self.logger.info('Message processed succesfully, deleting message.')
-                self.__queue.delete(message=message)
+            if self.executor is None:
+                if self.stopping.is_set():
+                    # stop signal received while the previous message was processed in the polling thread
+                    self.release_unstarted_messages(messages[index:])
+                    break
+                self.complete_message(message, self.handle_message(message))
             else:
-                self.logger.info('Message processing failed.')
+                if self.PREFETCH_DEPTH:
+                    self.__prefetched[message] = self.prefetch_executor.submit(self.prefetch_message, message)
+                future = self.executor.submit(self.handle_message, message)
+                self.__in_flight[future] = message
+
+        if self.__in_flight:
+            self.wait_in_flight_messages(
+                timeout=0 if messages else max(self.MESSAGE_WAIT_TIME, self.IN_FLIGHT_WAIT_TIME),
+                return_when=futures.FIRST_COMPLETED
+            )
+        self.flush_messages()
+
+        return len(messages) != 0
+
+    def get_wait_time(self):
+        if self.consecutive_empty_receives:
+            # SQS long polling limit
+            return min(max(self.MESSAGE_WAIT_TIME, self.MESSAGE_IDLE_WAIT_TIME), 20)
+        return self.MESSAGE_WAIT_TIME
+
+    def get_idle_backoff_time(self):
+        attempt = self.consecutive_empty_receives - self.IDLE_BACKOFF_THRESHOLD
+        if attempt < 0:
+            return 0
+        # limiting the exponent to avoid huge numbers on a long idle run
+        return random.uniform(0, min(self.IDLE_BACKOFF_MAX, self.IDLE_BACKOFF_BASE * 2 ** min(attempt, 32)))
+
+    def idle_backoff(self):
+        delay = self.get_idle_backoff_time()
+        if delay:
+            self.logger.debug('Queue is empty, sleeping %s seconds', delay)
+            self.stats['idle_backoff_seconds'] += delay
+            self.stopping.wait(delay)
+
+    @property
+    def max_in_flight_messages(self):
+        return (
+            self.MAX_IN_FLIGHT_MESSAGES or max(self.CONCURRENCY, self.MESSAGE_BATCH_SIZE)
+        ) + self.PREFETCH_DEPTH
+
+    @property
+    def executor(self):
+        if self.__executor is None and (self.CONCURRENCY > 1 or self.PREFETCH_DEPTH):
+            self.__executor = futures.ThreadPoolExecutor(
+                max_workers=self.CONCURRENCY,
+                thread_name_prefix=self.__class__.__name__
+            )
+        return self.__executor
+
+    @property
+    def prefetch_executor(self):
+        if self.__prefetch_executor is None:
+            if not self.MESSAGE_HEARTBEAT_INTERVAL:
+                self.logger.warning('Prefetching without heartbeat, prefetched messages may become visible')
+            self.__prefetch_executor = futures.ThreadPoolExecutor(
+                max_workers=self.PREFETCH_DEPTH,
+                thread_name_prefix=f'{self.__class__.__name__}Prefetch'
+            )
+        return self.__prefetch_executor
+
+    # returns prefetch_message result, prefetches the message in place if prefetching is disabled
+    def get_prefetched(self, message):
+        future = self.__prefetched.pop(message, None)
+        if future is None:
+            return self.prefetch_message(message)
+        return future.result()
+
+    # cleans up after the prefetched message which will not be processed
+    def discard_prefetched(self, message, future):
+        if not future.cancelled() and future.exception() is None:
+            self.discard_prefetch_result(message, future.result())
+
+    def wait_in_flight_messages(self, timeout=None, return_when=futures.ALL_COMPLETED):
+        done, not_done = futures.wait(
+            self.__in_flight,
+            timeout=timeout,
+            return_when=return_when
+        )
+        for future in done:
+            self.complete_message(self.__in_flight.pop(future), future.result())
+
+    # process_message wrapper, the messages may be processed in parallel
+    # therefore all the message related state must be kept in the local scope
+    def handle_message(self, message):
+        try:
+            result = self.process_message(message)
+        except Exception as e:
+            self.logger.error('Unexpected error while processing message %s', message.id, exc_info=True)
+            self.set_failure_reason(message, e)
+            result = False
+        finally:
+            # prefetched but not used by process_message
+            future = self.__prefetched.pop(message, None)
+            if future is not None:
+                future.add_done_callback(functools.partial(self.discard_prefetched, message))
+        if result:
+            self.logger.info('Message %s processed succesfully.', message.id)
+        else:
+            self.logger.info('Message %s processing failed.', message.id)
+        return result
+
+    def complete_message(self, message, result):
+        with self.__heartbeat_lock:
+            self.__heartbeat_messages.pop(message, None)
+        if result:
+            self.stats['messages_processed'] += 1
+            self.__processed.append(message)
+        else:
+            self.stats['messages_failed'] += 1
+            self.__failed.append(message)
+
+    # records why the message processing failed, the reason is sent to the parking queue
+    def set_failure_reason(self, message, reason):
+        if isinstance(reason, Exception):
+            reason = f'{reason.__class__.__name__}: {reason}'
+        self.__failure_reasons[message] = reason
+
+    def flush_messages(self):
+        processed, self.__processed = self.__processed, []
+        failed, self.__failed = self.__failed, []
+        self.delete_messages(processed)
+        self.retry_messages(failed)
 
-        return message is not None
+    def get_retry_visibility_timeout(self, message):
+        if self.MESSAGE_RETRY_BACKOFF_BASE:
+            # limiting the exponent to avoid huge numbers on a long failing message
+            return min(
+                self.MESSAGE_RETRY_BACKOFF_MAX,
+                self.MESSAGE_RETRY_BACKOFF_BASE * 2 ** min(message.receive_count - 1, 32)
+            )
+        if self.MESSAGE_HEARTBEAT_INTERVAL:
+            return 0
+        return None
+
+    # seconds left until the message becomes visible to other consumers, None if there is no limit.
+    # With the heartbeat enabled messages are kept invisible up to MESSAGE_MAX_VISIBILITY_TIMEOUT
+    def get_remaining_visibility_timeout(self, message):
+        if not self.MESSAGE_VISIBILITY_TIMEOUT:
+            return None
+        elapsed = time.monotonic() - message.received
+        if self.MESSAGE_HEARTBEAT_INTERVAL:
+            return self.MESSAGE_MAX_VISIBILITY_TIMEOUT - elapsed
+        return self.MESSAGE_VISIBILITY_TIMEOUT - elapsed
+
+    def is_poison_message(self, message):
+        return (
+            self.__parking_queue is not None
+            and self.MESSAGE_MAX_RECEIVE_COUNT
+            and message.receive_count >= self.MESSAGE_MAX_RECEIVE_COUNT
+        )
+
+    # parks the messages which failed too many times, delays the rest
+    def retry_messages(self, messages):
+        if not messages:
+            return
+        reasons = {message: self.__failure_reasons.pop(message, None) for message in messages}
+        parked = self.park_messages(
+            [message for message in messages if self.is_poison_message(message)],
+            reasons
+        )
+        # timeout -> messages
+        delayed = collections.defaultdict(list)
+        for message in messages:
+            if message in parked:
+                continue
+            timeout = self.get_retry_visibility_timeout(message)
+            if timeout is not None:
+                delayed[timeout].append(message)
+        for timeout, messages in delayed.items():
+            self.delay_messages(messages, timeout)
+
+    # returns messages moved to the parking queue
+    def park_messages(self, messages, reasons):
+        parked = []
+        for message in messages:
+            body = dict(
+                queue=self.__queue.name,
+                message_id=message.id,
+                receive_count=message.receive_count,
+                reason=reasons.get(message) or 'unknown',
+                body=message.body
+            )
+            try:
+                self.__parking_queue.post(body=json.dumps(body))
+            except Exception:
+                # message stays in the queue and will be retried
+                self.logger.error('Failed to park message %s', message.id, exc_info=True)
+                continue
+            self.logger.warning(
+                'Message %s failed %s times, moved to the parking queue. Reason: %s',
+                message.id,
+                message.receive_count,
+                body['reason']
+            )
+            parked.append(message)
+        self.stats['messages_parked'] += len(parked)
+        self.delete_messages(parked)
+        return parked
+
+    def delete_messages(self, messages):
+        if not messages:
+            return
+        self.logger.info('Deleting %s processed messages.', len(messages))
+        for message, error in self.__queue.delete_many(messages=messages):
+            # message will be redelivered after visibility timeout
+            self.logger.error(
+                'Failed to delete message %s. Code: %s. Reason: %s',
+                message.id,
+                error.get('Code'),
+                error.get('Message')
+            )
+
+    def release_unstarted_messages(self, messages):
+        with self.__heartbeat_lock:
+            for message in messages:
+                self.__heartbeat_messages.pop(message, None)
+        self.logger.info('Worker is stopping, releasing %s not started messages', len(messages))
+        self.stats['messages_released'] += len(messages)
+        self.release_messages(messages)
+
+    # makes messages visible for other consumers right away
+    def release_messages(self, messages):
+        self.delay_messages(messages, 0)
+
+    # makes messages visible for other consumers in timeout seconds
+    def delay_messages(self, messages, timeout):
+        if not messages:
+            return
+        if timeout:
+            self.logger.info('Delaying %s messages by %s seconds.', len(messages), timeout)
+        else:
+            self.logger.info('Releasing %s messages.', len(messages))
+        for message, error in self.__queue.change_visibility_many(messages=messages, timeout=timeout):
+            self.logger.error(
+                'Failed to change visibility timeout of message %s. Code: %s. Reason: %s',
+                message.id,
+                error.get('Code'),
+                error.get('Message')
+            )
+
+    def start_heartbeat(self, messages):
+        if not self.MESSAGE_HEARTBEAT_INTERVAL:
+            return
+        now = time.monotonic()
+        with self.__heartbeat_lock:
+            for message in messages:
+                self.__heartbeat_messages[message] = (now, now + self.MESSAGE_VISIBILITY_TIMEOUT)
+        if self.__heartbeat_thread is None:
+            self.__heartbeat_stop.clear()
+            self.__heartbeat_thread = threading.Thread(
+                target=self.heartbeat,
+                name=f'{self.__class__.__name__}Heartbeat',
+                daemon=True
+            )
+            self.__heartbeat_thread.start()
+
+    def heartbeat(self):
+        while not self.__heartbeat_stop.wait(self.MESSAGE_HEARTBEAT_INTERVAL):
+            try:
+                self.extend_visibility()
+            except Exception:
+                self.logger.error('Heartbeat failed', exc_info=True)
+
+    # extends visibility timeout of the messages which may become visible before the next heartbeat
+    def extend_visibility(self):
+        now = time.monotonic()
+        timeout = self.MESSAGE_VISIBILITY_TIMEOUT
+        with self.__heartbeat_lock:
+            messages = [
+                message
+                for message, (received, visible_until) in self.__heartbeat_messages.items()
+                if visible_until - now <= 2 * self.MESSAGE_HEARTBEAT_INTERVAL
+                and now + timeout - received <= self.MESSAGE_MAX_VISIBILITY_TIMEOUT
+            ]
+        if not messages:
+            return
+        self.logger.info('Extending visibility timeout of %s messages by %s seconds', len(messages), timeout)
+        failed = {
+            message: error
+            for message, error in self.__queue.change_visibility_many(messages=messages, timeout=timeout)
+        }
+        with self.__heartbeat_lock:
+            for message in messages:
+                if message in failed:
+                    self.logger.error(
+                        'Failed to extend visibility timeout of message %s. Code: %s. Reason: %s',
+                        message.id,
+                        failed[message].get('Code'),
+                        failed[message].get('Message')
+                    )
+                # message may be completed already
+                elif message in self.__heartbeat_messages:
+                    received, visible_until = self.__heartbeat_messages[message]
+                    self.__heartbeat_messages[message] = (received, now + timeout)
+
+    def stop_heartbeat(self):
+        if self.__heartbeat_thread is not None:
+            self.__heartbeat_stop.set()
+            self.__heartbeat_thread.join()
+            self.__heartbeat_thread = None
+
+    # waits for in flight messages, acknowledges processed ones and releases the rest
+    def stop(self, timeout=None):
+        if self.__in_flight:
+            self.logger.info('Waiting for %s in flight messages', len(self.__in_flight))
+            self.wait_in_flight_messages(timeout=timeout)
+        if self.__in_flight:
+            # queued messages will not start, running ones are left to finish but their results are ignored
+            for future in self.__in_flight:
+                future.cancel()
+            unfinished = list(self.__in_flight.values())
+            self.__in_flight.clear()
+            with self.__heartbeat_lock:
+                for message in unfinished:
+                    self.__heartbeat_messages.pop(message, None)
+            for message in unfinished:
+                future = self.__prefetched.pop(message, None)
+                if future is not None and not future.cancel():
+                    future.add_done_callback(functools.partial(self.discard_prefetched, message))
+            self.logger.info('%s in flight messages not finished in %s seconds', len(unfinished), timeout)
+            self.stats['messages_released'] += len(unfinished)
+            self.release_messages(unfinished)
+        self.flush_messages()
+        self.stop_heartbeat()
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=False)
+            self.__executor = None
+        if self.__prefetch_executor is not None:
+            self.__prefetch_executor.shutdown(wait=False)
+            self.__prefetch_executor = None
+        self.logger.info('Stopped. Stats: %s', dict(self.stats))
+
+    def handle_signal(self, signum, frame):
+        self.logger.info('Received signal %s, stopping', signum)
+        self.stopping.set()
+
+    def limit_reached(self):
+        if self.MAX_MESSAGES and self.stats['messages_received'] >= self.MAX_MESSAGES:
+            self.logger.info('Messages limit %s reached', self.MAX_MESSAGES)
+            return True
+        if self.MAX_MEMORY:
+            # kilobytes on linux
+            memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            if memory >= self.MAX_MEMORY:
+                self.logger.info('Memory limit %s MB reached. Peak memory usage: %s MB', self.MAX_MEMORY, memory)
+                return True
+        return False
+
+    # prepares the message for processing, e.g. downloads related files.
+    # Runs in a prefetch thread ahead of process_message when PREFETCH_DEPTH is set,
+    # process_message gets the result(or exception) using get_prefetched
+    def prefetch_message(self, message):  # pragma: no cover
+        return None
+
+    def discard_prefetch_result(self, message, result):  # pragma: no cover
+        pass
+
+    # waits for the services required to process messages, messages are received only if it returns True
+    def wait_until_ready(self):  # pragma: no cover
+        return True
 
     def process_message(self, message):  # pragma: no cover
         return True
 
+    # returns True if the worker was stopped by a signal or reached its limits, False if it failed
     def start(self):  # pragma: no cover
         try:
             # Set START_TIMESTAMP using bash START_TIMESTAMP="$(date +%s)"
@@ -54,10 +530,31 @@ class QueuePollingWorker:
             self.logger.info('Started in %s seconds', start_time)
         else:
             self.logger.info('Started')
+        self.stopping.clear()
+        handlers = dict()
+        # signal handlers can be set only in the main thread
+        if threading.current_thread() is threading.main_thread():
+            for signum in [signal.SIGTERM, signal.SIGINT]:
+                handlers[signum] = signal.signal(signum, self.handle_signal)
+        stopped = False
         try:
-            for result in self:
-                pass
+            ready_time = time.monotonic()
+            if self.wait_until_ready():
+                self.logger.info('Ready to receive messages in %s seconds', time.monotonic() - ready_time)
+                for result in self:
+                    if self.stopping.is_set() or self.limit_reached():
+                        stopped = True
+                        break
+            elif self.stopping.is_set():
+                stopped = True
+            else:
+                self.logger.error('Not ready to receive messages, stopping')
         except KeyboardInterrupt:
-            pass
+            stopped = True
         except Exception as e:
             self.logger.exception(e)
+        finally:
+            self.stop(timeout=self.SHUTDOWN_TIMEOUT)
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+        return stopped
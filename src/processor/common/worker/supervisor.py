@@ -0,0 +1,128 @@
+import os
+import sys
+import time
+import queue
+import signal
+import collections
+import multiprocessing
+from multiprocessing import connection
+from common import loggers
+
+
+supervisor_logger = loggers.logging.getLogger('WORKER_SUPERVISOR')
+
+
+def run_worker(worker_factory, stats_queue, max_messages, max_memory):
+    # forked process inherits supervisor signal handlers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    # worker and its connections must be created after fork, boto3 sessions can't be shared between processes
+    worker = worker_factory()
+    worker.MAX_MESSAGES = max_messages
+    worker.MAX_MEMORY = max_memory
+    stopped = worker.start()
+    stats_queue.put((os.getpid(), dict(worker.stats)))
+    # failed worker is restarted after the delay like a crashed one
+    if not stopped:
+        sys.exit(1)
+
+
+class WorkerSupervisor:
+
+    # delay before restarting a worker process which exited with an error
+    RESTART_DELAY = 1
+    # interval between supervisor checks of worker processes
+    CHECK_INTERVAL = 1
+
+    def __init__(
+        self,
+        worker_factory=None,
+        processes=None,
+        max_messages=0,
+        max_memory=0,
+        logger=None
+    ):
+        self.worker_factory = worker_factory
+        self.processes = processes or os.cpu_count()
+        self.max_messages = max_messages
+        self.max_memory = max_memory
+        self.logger = logger if logger else supervisor_logger
+        # worker modules and libraries are imported once and shared by forked processes
+        self.context = multiprocessing.get_context('fork')
+        self.stats_queue = self.context.Queue()
+        self.stats = collections.Counter()
+        self.workers = []
+        self.stopping = False
+
+    def spawn(self):
+        process = self.context.Process(
+            target=run_worker,
+            args=(
+                self.worker_factory,
+                self.stats_queue,
+                self.max_messages,
+                self.max_memory
+            )
+        )
+        process.start()
+        self.workers.append(process)
+        self.logger.info('Started worker process %s', process.pid)
+
+    def collect_stats(self):
+        while True:
+            try:
+                pid, stats = self.stats_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.logger.info('Worker process %s stats: %s', pid, stats)
+            self.stats.update(stats)
+
+    def handle_signal(self, signum, frame):
+        self.logger.info('Received signal %s, stopping worker processes', signum)
+        self.stop()
+
+    def stop(self):
+        self.stopping = True
+        for process in self.workers:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    def start(self):
+        self.logger.info('Starting %s worker processes', self.processes)
+        for i in range(self.processes):
+            self.spawn()
+        handlers = {
+            signum: signal.signal(signum, self.handle_signal)
+            for signum in [signal.SIGTERM, signal.SIGINT]
+        }
+        try:
+            self.supervise()
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+        self.collect_stats()
+        self.logger.info('Stopped. Stats: %s', dict(self.stats))
+
+    def supervise(self):
+        while self.workers:
+            sentinels = {process.sentinel: process for process in self.workers}
+            ready = connection.wait(list(sentinels), timeout=self.CHECK_INTERVAL)
+            self.collect_stats()
+            for sentinel in ready:
+                process = sentinels[sentinel]
+                process.join()
+                self.workers.remove(process)
+                if self.stopping:
+                    self.logger.info('Worker process %s stopped. Exit code: %s', process.pid, process.exitcode)
+                    continue
+                if process.exitcode == 0:
+                    # worker reached messages or memory limit
+                    self.logger.info('Worker process %s exited, restarting', process.pid)
+                else:
+                    self.logger.error('Worker process %s crashed. Exit code: %s', process.pid, process.exitcode)
+                    self.stats['crashes'] += 1
+                    time.sleep(self.RESTART_DELAY)
+                # supervisor may receive a signal during the restart delay
+                if not self.stopping:
+                    self.stats['restarts'] += 1
+                    self.spawn()
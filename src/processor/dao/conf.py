@@ -4,9 +4,15 @@ import os
 ARCHIVE_BUCKET = os.environ.get('ARCHIVE_BUCKET_NAME')
 UNPROCESSED_BUCKET = os.environ.get('UNPROCESSED_BUCKET_NAME')
 QUARANTINE_BUCKET = os.environ.get('QUARANTINE_BUCKET_NAME')
+# scan verdicts shared by virus scanners, optional
+VERDICT_CACHE_BUCKET = os.environ.get('VERDICT_CACHE_BUCKET_NAME')
 
 VALIDATION_QUEUE = os.environ.get('VALIDATION_QUEUE_NAME')
 VIRUS_SCANNING_QUEUE = os.environ.get('VIRUS_SCANNING_QUEUE_NAME')
+# events of files larger than LARGE_FILE_SIZE, optional
+VIRUS_SCANNING_LARGE_FILES_QUEUE = os.environ.get('VIRUS_SCANNING_LARGE_FILES_QUEUE_NAME')
+# messages which failed too many times are moved here, optional
+PARKING_QUEUE = os.environ.get('PARKING_QUEUE_NAME')
 
 VIRUS_NOTIFICATION_TOPIC = os.environ.get('VIRUS_NOTIFICATION_TOPIC_ARN')
 
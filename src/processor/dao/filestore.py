@@ -2,7 +2,8 @@ from common.dao.filestore import FileStore
 from .conf import (
     QUARANTINE_BUCKET,
     UNPROCESSED_BUCKET,
-    ARCHIVE_BUCKET
+    ARCHIVE_BUCKET,
+    VERDICT_CACHE_BUCKET
 )
 
 
@@ -28,3 +29,11 @@ class Unprocessed(FileStore):
             bucket=UNPROCESSED_BUCKET,
             connection_conf=connection_conf
         )
+
+
+class Verdicts(FileStore):
+    def __init__(self, connection_conf=None):
+        super().__init__(
+            bucket=VERDICT_CACHE_BUCKET,
+            connection_conf=connection_conf
+        )
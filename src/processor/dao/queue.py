@@ -1,7 +1,9 @@
 from common.dao.queue import Queue
 from .conf import (
     VALIDATION_QUEUE,
-    VIRUS_SCANNING_QUEUE
+    VIRUS_SCANNING_QUEUE,
+    VIRUS_SCANNING_LARGE_FILES_QUEUE,
+    PARKING_QUEUE
 )
 
 
@@ -13,9 +15,25 @@ class VirusScanning(Queue):
         )
 
 
+class VirusScanningLargeFiles(Queue):
+    def __init__(self, connection_conf=None):
+        super().__init__(
+            queue=VIRUS_SCANNING_LARGE_FILES_QUEUE,
+            connection_conf=connection_conf
+        )
+
+
 class Validation(Queue):
     def __init__(self, connection_conf=None):
         super().__init__(
             queue=VALIDATION_QUEUE,
             connection_conf=connection_conf
         )
+
+
+class Parking(Queue):
+    def __init__(self, connection_conf=None):
+        super().__init__(
+            queue=PARKING_QUEUE,
+            connection_conf=connection_conf
+        )
@@ -30,6 +30,14 @@ class ArchiveExists(Exception):
 class ArchiverWorker:
 
     TIMEZONE = pytz.timezone(os.environ['ARCHIVE_TIMEZONE'])
+    # number of files downloaded in parallel and download attempts of each file after the first one
+    DOWNLOAD_CONCURRENCY = int(os.environ.get('ARCHIVER_WORKER_DOWNLOAD_CONCURRENCY', 32))
+    DOWNLOAD_RETRIES = int(os.environ.get('ARCHIVER_WORKER_DOWNLOAD_RETRIES', 3))
+    # number of DeleteObjects requests of up to 1000 keys running in parallel
+    DELETE_CONCURRENCY = int(os.environ.get('ARCHIVER_WORKER_DELETE_CONCURRENCY', 4))
+    # archive larger than the part size is uploaded in parts, number of parts uploaded in parallel
+    UPLOAD_PART_SIZE = 1024 * 1024 * int(os.environ.get('ARCHIVER_WORKER_UPLOAD_PART_SIZE', 64))  # MB
+    UPLOAD_CONCURRENCY = int(os.environ.get('ARCHIVER_WORKER_UPLOAD_CONCURRENCY', 8))
 
     def __init__(
         self,
@@ -86,7 +94,7 @@ class ArchiverWorker:
 
     def check_archive_not_exists(self):
         self.logger.info('Checking that archive file %s does not exist...', self.archive_filestore_key)
-        if self.archive_filestore_dao.get(key=self.archive_filestore_key) is not None:
+        if self.archive_filestore_dao.head(key=self.archive_filestore_key) is not None:
             raise ArchiveExists()
         self.logger.info('Archive file %s not found. Continuing...', self.archive_filestore_key)
 
@@ -96,19 +104,21 @@ class ArchiverWorker:
             self.download_files_key_prefix,
             self.archive_files_download_dir
         )
-        number_of_files = self.archive_filestore_dao.download(
+        stats = self.archive_filestore_dao.download(
             recursive=True,
             key=self.download_files_key_prefix,
-            path=self.archive_files_download_dir
+            path=self.archive_files_download_dir,
+            max_workers=self.DOWNLOAD_CONCURRENCY,
+            retries=self.DOWNLOAD_RETRIES
         )
-        if number_of_files == 0:
+        if stats.files == 0:
             raise NoFilesToArchive()
-        size = self.get_size(self.archive_files_download_dir)
         self.logger.info(
-            'Downloaded %i files from %s. Size %f MB',
-            number_of_files,
+            'Downloaded %i files from %s in %f seconds. Size %f MB',
+            stats.files,
             self.download_files_key_prefix,
-            size
+            stats.seconds,
+            stats.bytes / 1024 / 1024
         )
 
     def zip_files(self):
@@ -130,24 +140,31 @@ class ArchiverWorker:
         )
 
     def send_zip_to_archive_compressed_dir(self):
-        with open(self.compressed_archive_file_path, 'rb') as f:
-            self.logger.info(
-                'Uploading compressed archive as %s',
-                self.archive_filestore_key
-            )
-            start_time = time.time()
-            self.archive_filestore_dao.post(
-                body=f,
-                key=self.archive_filestore_key
-            )
-            self.logger.info('Uploading completed in %f seconds', time.time() - start_time)
+        self.logger.info(
+            'Uploading compressed archive as %s',
+            self.archive_filestore_key
+        )
+        # parts are read from the archive file when they are sent instead of being buffered in memory
+        stats = self.archive_filestore_dao.upload(
+            key=self.archive_filestore_key,
+            path=self.compressed_archive_file_path,
+            part_size=self.UPLOAD_PART_SIZE,
+            max_workers=self.UPLOAD_CONCURRENCY
+        )
+        self.logger.info(
+            'Uploaded %i bytes in %f seconds, %f MB/s',
+            stats.bytes,
+            stats.seconds,
+            stats.bytes / 1024 / 1024 / max(stats.seconds, 0.001)
+        )
 
     def delete_unzipped_files_from_archive_valid_dir(self):
         self.logger.info('Deleting uncompressed directory %s from archive', self.download_files_key_prefix)
         start_time = time.time()
         number_of_files = self.archive_filestore_dao.delete(
             recursive=True,
-            key=self.download_files_key_prefix
+            key=self.download_files_key_prefix,
+            max_workers=self.DELETE_CONCURRENCY
         )
         self.logger.info('Deleted %i files in %f seconds', number_of_files, time.time() - start_time)
 
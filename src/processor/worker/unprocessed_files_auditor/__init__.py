@@ -1,7 +1,9 @@
 import os
 import datetime
+import collections
 import pytz
 import common.event
+from common.dao.queue import BatchSender, SendError
 from dao import (
     queue,
     filestore,
@@ -13,76 +15,98 @@ from common.loggers import logging
 default_logger = logging.getLogger('UNPROCESSED_FILES_AUDITOR')
 
 
-class FileMovedError(Exception):
-    pass
-
-
 class UnprocessedFilesAuditorWorker:
 
     TIMEZONE = pytz.timezone(os.environ['ARCHIVE_TIMEZONE'])
     RESEND_INTERVAL = int(os.environ['AUDIT_EVENT_RESEND_INTERVAL'])
+    # events of larger files are sent to the large files queue if it's set, 0 disables the routing
+    LARGE_FILE_SIZE = 1024 * 1024 * int(os.environ.get('LARGE_FILE_SIZE', 0))  # MB
 
     def __init__(
         self,
         virus_scanning_queue_dao=None,
         unprocessed_filestore_dao=None,
-        logger=None
+        logger=None,
+        large_files_queue_dao=None
     ):
         self.logger = logger if logger else default_logger
         self.virus_scanning_queue_dao = virus_scanning_queue_dao
         self.unprocessed_filestore_dao = unprocessed_filestore_dao
+        self.virus_scanning_queue_sender = BatchSender(queue=virus_scanning_queue_dao)
+        self.large_files_queue_sender = None
+        if large_files_queue_dao is not None:
+            self.large_files_queue_sender = BatchSender(queue=large_files_queue_dao)
 
     def get_utc_now(self):  # pragma: no cover
         return datetime.datetime.utcnow()
 
-    def load_file(self, key):
-        file = self.unprocessed_filestore_dao.get(key)
-        if file is None:
-            raise FileMovedError()
-        return file
-
-    def try_to_resend_file_put_event(self, key, now):
-        self.logger.info('Checking file %s', key)
-        file = None
-        submission_time = None
-        try:
-            file = self.load_file(key)
-            submission_time = file['LastModified'].astimezone(self.TIMEZONE)
-
-            self.logger.info('File submission time:%s', submission_time.isoformat())
-            if now - submission_time < datetime.timedelta(seconds=self.RESEND_INTERVAL):
-                self.logger.info('Event resend is not needed')
-                return
-
-            # creating mininal required fields in event
-            event = common.event.create_minimal_valid_file_put_event(
-                key=key,
-                etag=file['ETag'],
-                size=file['ContentLength'],
-                bucket=self.unprocessed_filestore_dao.bucket.name,
-                event_time=submission_time
-            )
-            self.logger.info('Resending put event')
-            # pushing event to virus scanner queue
-            self.virus_scanning_queue_dao.post(
-                event,
-                delay=0
-            )
-        except FileMovedError:
-            self.logger.info('File %s is no longer accessible. Skip.', key)
+    # returns the event send future if the event was resent.
+    # file is ObjectSummary from the listing, files moved after the listing are skipped by virus scanner
+    # because their etag doesn't match
+    def try_to_resend_file_put_event(self, file, now):
+        self.logger.info('Checking file %s', file.key)
+        # listing time has milliseconds, they are dropped to match Last-Modified header time
+        submission_time = file.last_modified.replace(microsecond=0).astimezone(self.TIMEZONE)
+
+        self.logger.info('File submission time:%s', submission_time.isoformat())
+        if now - submission_time < datetime.timedelta(seconds=self.RESEND_INTERVAL):
+            self.logger.info('Event resend is not needed')
+            return
+
+        # creating mininal required fields in event
+        event = common.event.create_minimal_valid_file_put_event(
+            key=file.key,
+            etag=file.etag,
+            size=file.size,
+            bucket=self.unprocessed_filestore_dao.bucket.name,
+            event_time=submission_time
+        )
+        self.logger.info('Resending put event')
+        # pushing event to virus scanner queue, events are sent in batches
+        return self.get_sender(file.size).post(
+            body=event,
+            delay=0
+        )
+
+    def get_sender(self, size):
+        if self.large_files_queue_sender is not None and self.LARGE_FILE_SIZE and size > self.LARGE_FILE_SIZE:
+            return self.large_files_queue_sender
+        return self.virus_scanning_queue_sender
 
     def start(self):
         # There aren't a lot of exceptions which it can handle
         # and everything should end up in sentry logs anyway.
-        # Therefore there is no custom logging here except invalid key scenario & file moved error
+        # Therefore there is no custom logging here except invalid key scenario
         now = self.get_utc_now().astimezone(self.TIMEZONE)
         self.logger.info('Starting. NOW: %s', now.isoformat())
-        for key in self.unprocessed_filestore_dao.list():
-            self.try_to_resend_file_put_event(key, now)
+        # (key, future) pairs of the events being sent, completed ones are checked while listing
+        resent = collections.deque()
+        try:
+            for file in self.unprocessed_filestore_dao.list_objects():
+                future = self.try_to_resend_file_put_event(file, now)
+                if future is not None:
+                    resent.append((file.key, future))
+                while resent and resent[0][1].done():
+                    self.check_resent(*resent.popleft())
+        finally:
+            self.virus_scanning_queue_sender.close()
+            if self.large_files_queue_sender is not None:
+                self.large_files_queue_sender.close()
+        while resent:
+            self.check_resent(*resent.popleft())
+
+    def check_resent(self, key, future):
+        try:
+            future.result()
+        except SendError as e:
+            self.logger.error('Failed to resend put event of %s. Reason: %s', key, e)
 
 
 if __name__ == '__main__':
     UnprocessedFilesAuditorWorker(
         virus_scanning_queue_dao=queue.VirusScanning(conf.get_sqs_env_conf()),
-        unprocessed_filestore_dao=filestore.Unprocessed(conf.get_s3_env_conf())
+        unprocessed_filestore_dao=filestore.Unprocessed(conf.get_s3_env_conf()),
+        large_files_queue_dao=(
+            queue.VirusScanningLargeFiles(conf.get_sqs_env_conf()) if conf.VIRUS_SCANNING_LARGE_FILES_QUEUE else None
+        )
     )
@@ -5,6 +5,7 @@ import posixpath
 import common.event
 from common.dao.filestore import FileChangedError
 from common.worker.queue_polling import QueuePollingWorker
+from common.worker.supervisor import WorkerSupervisor
 from common import loggers
 from dao import (
     queue,
@@ -28,17 +29,28 @@ class ValidatorWorker(QueuePollingWorker):
 
     MESSAGE_WAIT_TIME = int(os.environ['VALIDATOR_WORKER_MSG_WAIT_TIME'])
     MESSAGE_VISIBILITY_TIMEOUT = int(os.environ['VALIDATOR_WORKER_MSG_VISIBILITY_TIMEOUT'])
+    MESSAGE_BATCH_SIZE = int(os.environ.get('VALIDATOR_WORKER_MSG_BATCH_SIZE', 1))
+    CONCURRENCY = int(os.environ.get('VALIDATOR_WORKER_CONCURRENCY', 1))
+    MESSAGE_HEARTBEAT_INTERVAL = int(os.environ.get('VALIDATOR_WORKER_MSG_HEARTBEAT_INTERVAL', 0))
+    MESSAGE_IDLE_WAIT_TIME = int(os.environ.get('VALIDATOR_WORKER_MSG_IDLE_WAIT_TIME', 20))
+    IDLE_BACKOFF_MAX = int(os.environ.get('VALIDATOR_WORKER_IDLE_BACKOFF_MAX', 60))
+    SHUTDOWN_TIMEOUT = int(os.environ.get('VALIDATOR_WORKER_SHUTDOWN_TIMEOUT', 20))
+    MESSAGE_RETRY_BACKOFF_BASE = int(os.environ.get('VALIDATOR_WORKER_MSG_RETRY_BACKOFF_BASE', 0))
+    MESSAGE_RETRY_BACKOFF_MAX = int(os.environ.get('VALIDATOR_WORKER_MSG_RETRY_BACKOFF_MAX', 60 * 60))
+    MESSAGE_MAX_RECEIVE_COUNT = int(os.environ.get('VALIDATOR_WORKER_MSG_MAX_RECEIVE_COUNT', 0))
 
     TIMEZONE = pytz.timezone(os.environ['ARCHIVE_TIMEZONE'])
 
     def __init__(
         self,
         validation_queue_dao=None,
-        unprocessed_filestore_dao=None
+        unprocessed_filestore_dao=None,
+        parking_queue_dao=None
     ):
         super().__init__(
             queue_dao=validation_queue_dao,
-            logger=logger
+            logger=logger,
+            parking_queue_dao=parking_queue_dao
         )
         self.validation_queue_dao = validation_queue_dao
         self.unprocessed_filestore_dao = unprocessed_filestore_dao
@@ -78,8 +90,9 @@ class ValidatorWorker(QueuePollingWorker):
                 exc_info=True
             )
             return True
-        except Exception:
+        except Exception as e:
             logger.error('Unexpected error occured', exc_info=True)
+            self.set_failure_reason(message, e)
             return False
 
     def download_json_file(self, event):
@@ -91,10 +104,30 @@ class ValidatorWorker(QueuePollingWorker):
             )
             if fileobj is None:
                 raise FileChangedError()
-            return json.loads(fileobj['Body'].read())
+            return self.load_json(fileobj['Body'].read())
         except ValueError as e:
             raise FileIsNotJSON() from e
 
+    def load_json(self, content):
+        try:
+            return json.loads(content)
+        except ValueError as e:
+            raise FileIsNotJSON() from e
+
+    # moves the file into the archive by its already downloaded content,
+    # used by the virus scanner to validate scanned files without downloading them again
+    def archive_file(self, event, content):
+        key = event['s3']['object']['key']
+        try:
+            self.load_json(content)
+        except FileIsNotJSON:
+            self.logger.info('File %s is not JSON', key)
+            self.move_file_to_invalid_dir(event)
+            return False
+        self.logger.info('File %s passed validation', key)
+        self.move_file_to_valid_dir(event)
+        return True
+
     def get_archive_key_from_event(self, event, prefix):
         obj = event['s3']['object']
         key = obj['key']
@@ -130,8 +163,19 @@ class ValidatorWorker(QueuePollingWorker):
         self.move_file_to_archive(event, conf.ARCHIVE_BUCKET_INVALID_DIR)
 
 
+def create_worker():
+    sqs_connection_data = conf.get_sqs_env_conf()
+    return ValidatorWorker(
+        validation_queue_dao=queue.Validation(sqs_connection_data),
+        unprocessed_filestore_dao=filestore.Unprocessed(conf.get_s3_env_conf()),
+        parking_queue_dao=queue.Parking(sqs_connection_data) if conf.PARKING_QUEUE else None
+    )
+
+
 if __name__ == '__main__':
-    ValidatorWorker(
-        validation_queue_dao=queue.Validation(conf.get_sqs_env_conf()),
-        unprocessed_filestore_dao=filestore.Unprocessed(conf.get_s3_env_conf())
+    WorkerSupervisor(
+        worker_factory=create_worker,
+        processes=int(os.environ.get('VALIDATOR_WORKER_PROCESSES', 0)),
+        max_messages=int(os.environ.get('VALIDATOR_WORKER_MAX_MESSAGES_PER_PROCESS', 0)),
+        max_memory=int(os.environ.get('VALIDATOR_WORKER_MAX_MEMORY_PER_PROCESS', 0))
     ).start()
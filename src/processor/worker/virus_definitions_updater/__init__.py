@@ -1,13 +1,41 @@
 import os
+import json
+import time
 import subprocess
 from common import loggers
+from common.clamd import Clamd, ClamdError, parse_definitions_version
 
 
 logger = loggers.logging.getLogger('VIRUS_DEFINITIONS_UPDATER')
 
 
+def get_default_clamd_endpoint():
+    if os.environ.get('CLAMD_HOST'):
+        return f"{os.environ['CLAMD_HOST']}:{os.environ.get('CLAMD_PORT', 3310)}"
+    return os.environ.get('CLAMD_SOCKET', '/var/run/clamav/clamd.sock')
+
+
+# version reported by clamd is the version of the daily database(daily.cvd or daily.cld)
+def is_daily_definitions(filename):
+    return 'daily' in os.path.basename(filename)
+
+
 class VirusDefinitionsUpdater:
 
+    # clamd instances reloaded after definitions update: comma separated unix socket paths or host[:port].
+    # Defaults to CLAMD_HOST:CLAMD_PORT or CLAMD_SOCKET
+    CLAMD_ENDPOINTS = [
+        endpoint.strip()
+        for endpoint in os.environ.get('CLAMD_ENDPOINTS', get_default_clamd_endpoint()).split(',')
+        if endpoint.strip()
+    ]
+    CLAMD_TIMEOUT = int(os.environ.get('CLAMD_TIMEOUT', 60))
+    # max time in seconds to wait for clamd to report the new definitions version after RELOAD
+    CLAMD_RELOAD_TIMEOUT = int(os.environ.get('VIRUS_DEFINITIONS_UPDATER_RELOAD_TIMEOUT', 120))
+    # loaded definitions version is written into this file for virus scanners, optional.
+    # The endpoint being reloaded is written into <VERSION_FILE>.reloading, so scanners take it out of rotation
+    VERSION_FILE = os.environ.get('VIRUS_DEFINITIONS_VERSION_FILE')
+
     def run(self):
         try:
             VIRUS_DEFINITIONS_DIR = os.environ['VIRUS_DEFINITIONS_DIR']
@@ -102,6 +130,10 @@ class VirusDefinitionsUpdater:
                 )
             if not missing_definition_files:
                 logger.info('Virus definitions updated succesfully!')
+                if updated_files:
+                    self.reload_clamd(
+                        wait_for_version=any(is_daily_definitions(filename) for filename in updated_files)
+                    )
                 return True
             else:
                 return False
@@ -113,6 +145,96 @@ class VirusDefinitionsUpdater:
             except (ProcessLookupError, UnboundLocalError):
                 pass
 
+    # makes clamd load the updated definitions and publishes their version.
+    # Failed reload doesn't fail the update, clamd loads the definitions on the next restart.
+    # Other endpoints are reloaded anyway, only the version is not published then
+    def reload_clamd(self, wait_for_version=True):
+        versions = set()
+        failed = []
+        try:
+            # endpoints are reloaded one by one, so the others keep scanning
+            for endpoint in self.CLAMD_ENDPOINTS:
+                clamd = Clamd.from_endpoint(endpoint, timeout=self.CLAMD_TIMEOUT)
+                self.publish_reloading(clamd.name)
+                try:
+                    versions.add(self.reload(clamd, wait_for_version=wait_for_version))
+                except (OSError, ClamdError):
+                    logger.error('Failed to reload clamd %s', clamd.name, exc_info=True)
+                    failed.append(clamd.name)
+        finally:
+            self.publish_reloading(None)
+        if failed:
+            logger.warning('clamd %s failed to reload. Version is not published', failed)
+            return
+        if len(versions) != 1 or None in versions:
+            logger.warning('clamd definitions versions differ after reload: %s. Version is not published', versions)
+            return
+        self.publish_version(versions.pop())
+
+    # returns the definitions version loaded by clamd after RELOAD.
+    # The version changes only if the daily database was updated, otherwise
+    # reload is completed once clamd replies to PING
+    def reload(self, clamd, wait_for_version=True):
+        old_version = parse_definitions_version(clamd.version())
+        logger.info('Reloading clamd %s. Definitions version: %s', clamd.name, old_version)
+        start_time = time.monotonic()
+        clamd.reload()
+        version = None
+        while time.monotonic() - start_time < self.CLAMD_RELOAD_TIMEOUT:
+            try:
+                version = parse_definitions_version(clamd.version()) if clamd.ping() else None
+            except (OSError, ClamdError):
+                # clamd may not reply while loading definitions
+                version = None
+            if version is not None and (version != old_version or not wait_for_version):
+                break
+            time.sleep(1)
+        else:
+            # e.g. only main database was updated, daily version stays the same
+            logger.warning(
+                'clamd %s definitions version is %s %s seconds after reload',
+                clamd.name,
+                version,
+                self.CLAMD_RELOAD_TIMEOUT
+            )
+            return version
+        logger.info(
+            'clamd %s reloaded in %s seconds. Definitions version: %s',
+            clamd.name,
+            time.monotonic() - start_time,
+            version
+        )
+        return version
+
+    def publish_version(self, version):
+        if not self.VERSION_FILE:
+            return
+        self.write_file(self.VERSION_FILE, version)
+        logger.info('Definitions version %s published to %s', version, self.VERSION_FILE)
+
+    # scanners take the endpoint out of rotation until the reload timeout passes, None means nothing is reloading
+    def publish_reloading(self, name):
+        if not self.VERSION_FILE:
+            return
+        path = f'{self.VERSION_FILE}.reloading'
+        if name is None:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return
+        self.write_file(path, json.dumps(dict(
+            endpoint=name,
+            until=time.time() + self.CLAMD_RELOAD_TIMEOUT
+        )))
+
+    def write_file(self, path, content):
+        # readers never see a partially written file
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(content)
+        os.replace(temp_path, path)
+
 
 if __name__ == '__main__':
     VirusDefinitionsUpdater().run()
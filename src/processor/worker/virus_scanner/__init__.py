@@ -1,42 +1,169 @@
+import io
 import os
 import json
+import time
+import hashlib
 import posixpath
 import tempfile
 import subprocess
 import datetime
 import common.event
 from common import loggers
-from common.dao.filestore import FileChangedError
+from common.clamd import (
+    Clamd,
+    ClamdPool,
+    ClamdBalancer,
+    ClamdError,
+    ClamdTimeout,
+    parse_scan_reply,
+    parse_definitions_version
+)
+from common.verdict_cache import VerdictCache, CLEAN
+from common.scratch import ScratchSpace
+from common.dao.filestore import FileChangedError, FileTooLargeError
+from common.dao.queue import BatchSender
 from common.worker.queue_polling import QueuePollingWorker
+from common.worker.supervisor import WorkerSupervisor
 from dao.conf import (
     get_s3_env_conf,
     get_sqs_env_conf,
     get_sns_env_conf,
-    QUARANTINE_BUCKET
+    QUARANTINE_BUCKET,
+    PARKING_QUEUE,
+    VERDICT_CACHE_BUCKET,
+    VIRUS_SCANNING_LARGE_FILES_QUEUE
 )
 from dao import queue, filestore, notifications
 
 
 logger = loggers.logging.getLogger('VIRUS_SCANNER_WORKER')
+# small - scans files from the virus scanning queue forwarding large ones to the large files queue,
+# large - scans files from the large files queue
+TIER = os.environ.get('VIRUS_SCANNER_WORKER_TIER', 'small')
 
 
 class VirusDetected(Exception):
     pass
 
 
+class ScanTimeout(Exception):
+    pass
+
+
+# file object writing everything read from fileobj into copy
+class TeeReader:
+
+    def __init__(self, fileobj, copy):
+        self.fileobj = fileobj
+        self.copy = copy
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.copy.write(data)
+        return data
+
+
+# file object raising FileTooLargeError as soon as more than limit bytes are read from fileobj
+class LimitedReader:
+
+    def __init__(self, fileobj, limit):
+        self.fileobj = fileobj
+        self.limit = limit
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.size += len(data)
+        if self.size > self.limit:
+            raise FileTooLargeError(f'More than {self.limit} bytes read')
+        return data
+
+
 class VirusScannerWorker(QueuePollingWorker):
 
     MESSAGE_WAIT_TIME = int(os.environ['VIRUS_SCANNER_WORKER_MSG_WAIT_TIME'])
     MESSAGE_VISIBILITY_TIMEOUT = int(os.environ['VIRUS_SCANNER_WORKER_MSG_VISIBILITY_TIMEOUT'])
+    MESSAGE_BATCH_SIZE = int(os.environ.get('VIRUS_SCANNER_WORKER_MSG_BATCH_SIZE', 1))
+    CONCURRENCY = int(os.environ.get('VIRUS_SCANNER_WORKER_CONCURRENCY', 1))
+    MESSAGE_HEARTBEAT_INTERVAL = int(os.environ.get('VIRUS_SCANNER_WORKER_MSG_HEARTBEAT_INTERVAL', 0))
+    MESSAGE_IDLE_WAIT_TIME = int(os.environ.get('VIRUS_SCANNER_WORKER_MSG_IDLE_WAIT_TIME', 20))
+    IDLE_BACKOFF_MAX = int(os.environ.get('VIRUS_SCANNER_WORKER_IDLE_BACKOFF_MAX', 60))
+    SHUTDOWN_TIMEOUT = int(os.environ.get('VIRUS_SCANNER_WORKER_SHUTDOWN_TIMEOUT', 20))
+    MESSAGE_RETRY_BACKOFF_BASE = int(os.environ.get('VIRUS_SCANNER_WORKER_MSG_RETRY_BACKOFF_BASE', 0))
+    MESSAGE_RETRY_BACKOFF_MAX = int(os.environ.get('VIRUS_SCANNER_WORKER_MSG_RETRY_BACKOFF_MAX', 60 * 60))
+    MESSAGE_MAX_RECEIVE_COUNT = int(os.environ.get('VIRUS_SCANNER_WORKER_MSG_MAX_RECEIVE_COUNT', 0))
+    PREFETCH_DEPTH = int(os.environ.get('VIRUS_SCANNER_WORKER_PREFETCH_DEPTH', 0))
+    # max time in seconds events of files scanned in parallel wait to be forwarded in one batch
+    FORWARD_BATCH_MAX_WAIT = float(os.environ.get('VIRUS_SCANNER_WORKER_FORWARD_BATCH_MAX_WAIT', 0.05))
 
     MAX_FILE_SIZE = 1024 * 1024 * int(os.environ['MAX_FILE_SIZE'])  # MB
+    # events of larger files are forwarded to the large files queue so they don't delay small files,
+    # 0 disables the routing
+    LARGE_FILE_SIZE = 1024 * 1024 * int(os.environ.get('LARGE_FILE_SIZE', 0))  # MB
 
-    FILE_SCAN_DOWNLOAD_PATH = os.path.join(tempfile.gettempdir(), 'scan')
+    # fused mode: clean files are validated and moved to the archive by the scanner
+    # from the same download instead of forwarding their events to validator
+    VALIDATE = os.environ.get('VIRUS_SCANNER_WORKER_VALIDATE', 'false').lower() == 'true'
 
+    # clamdscan - files are downloaded and scanned by clamdscan process,
+    # clamd - files are streamed from S3 to clamd socket without saving them to disk
+    SCAN_ENGINE = os.environ.get('VIRUS_SCANNER_WORKER_SCAN_ENGINE', 'clamdscan')
+    SCAN_ENGINES = ['clamdscan', 'clamd']
+    CLAMD_SOCKET = os.environ.get('CLAMD_SOCKET', '/var/run/clamav/clamd.sock')
+    CLAMD_HOST = os.environ.get('CLAMD_HOST')
+    CLAMD_PORT = int(os.environ.get('CLAMD_PORT', 3310))
+    # comma separated clamd endpoints scans are spread across: unix socket paths or host[:port].
+    # Defaults to CLAMD_HOST:CLAMD_PORT or CLAMD_SOCKET
+    CLAMD_ENDPOINTS = [
+        endpoint.strip()
+        for endpoint in os.environ.get('CLAMD_ENDPOINTS', '').split(',')
+        if endpoint.strip()
+    ]
+    # max time in seconds to wait for clamd to load definitions on startup, messages are received only after that
+    CLAMD_STARTUP_TIMEOUT = int(os.environ.get('CLAMD_STARTUP_TIMEOUT', 300))
+    # endpoint which can't be connected is out of rotation for this number of seconds
+    CLAMD_RETRY_INTERVAL = int(os.environ.get('CLAMD_RETRY_INTERVAL', 5))
+    CLAMD_TIMEOUT = int(os.environ.get('CLAMD_TIMEOUT', 60))
+    CLAMD_STREAM_CHUNK_SIZE = 1024 * int(os.environ.get('CLAMD_STREAM_CHUNK_SIZE', 64))  # KB
+    # clamd sessions idle for longer than this number of seconds are checked with PING before use
+    CLAMD_PING_INTERVAL = int(os.environ.get('CLAMD_PING_INTERVAL', 1))
+
+    # number of scan verdicts cached in memory by file content hash and virus definitions version.
+    # 0 disables the cache
+    VERDICT_CACHE_SIZE = int(os.environ.get('VIRUS_SCANNER_WORKER_VERDICT_CACHE_SIZE', 10000))
+    # files streamed to clamd are hashed before the scan only if they fit into this buffer, KB
+    VERDICT_CACHE_STREAM_BUFFER_SIZE = 1024 * int(
+        os.environ.get('VIRUS_SCANNER_WORKER_VERDICT_CACHE_STREAM_BUFFER_SIZE', 1024)
+    )
+    # virus definitions version is requested from clamd once in this number of seconds
+    DEFINITIONS_VERSION_TTL = int(os.environ.get('VIRUS_SCANNER_WORKER_DEFINITIONS_VERSION_TTL', 60))
+    # version of definitions loaded by clamd published by virus definitions updater after reload, optional.
+    # It's used instead of requesting the version from clamd, so new verdicts are tagged with it right away.
+    # clamd endpoint reloaded by the updater is reported in <DEFINITIONS_VERSION_FILE>.reloading,
+    # it's out of rotation until the reload is completed
+    DEFINITIONS_VERSION_FILE = os.environ.get('VIRUS_DEFINITIONS_VERSION_FILE')
+
+    # downloaded files are saved into a private directory of the worker inside SCRATCH_DIR,
+    # e.g. tmpfs mounted /dev/shm to keep them in memory
+    SCRATCH_DIR = os.environ.get('VIRUS_SCANNER_WORKER_SCRATCH_DIR', tempfile.gettempdir())
+    # max total size of downloaded files, 0 means no limit. Downloads wait for space up to SCRATCH_TIMEOUT seconds
+    SCRATCH_SPACE = 1024 * 1024 * int(os.environ.get('VIRUS_SCANNER_WORKER_SCRATCH_SPACE', 0))  # MB
+    SCRATCH_TIMEOUT = int(os.environ.get('VIRUS_SCANNER_WORKER_SCRATCH_TIMEOUT', 60))
+
+    # max scan time in seconds, doubled on each receive of the message, 0 means no limit.
+    # Without the heartbeat scans are also limited by the message remaining visibility timeout
+    SCAN_TIMEOUT = int(os.environ.get('VIRUS_SCANNER_WORKER_SCAN_TIMEOUT', 300))
+    # files which scan still times out after their message was received SCAN_TIMEOUT_MAX_TRIES times
+    # are moved to quarantine, 0 means they are retried like other failed messages
+    SCAN_TIMEOUT_MAX_TRIES = int(os.environ.get('VIRUS_SCANNER_WORKER_SCAN_TIMEOUT_MAX_TRIES', 0))
+
+    # {path} is replaced with the downloaded file path.
+    # File descriptor is passed to clamd because clamd user can't read the private scratch directory
     VIRUS_SCAN_COMMAND = [
         'clamdscan',
-        FILE_SCAN_DOWNLOAD_PATH,
-        '--no-summary'
+        '{path}',
+        '--no-summary',
+        '--fdpass'
     ]
 
     def __init__(
@@ -45,34 +172,119 @@ class VirusScannerWorker(QueuePollingWorker):
         validation_queue_dao=None,
         unprocessed_filestore_dao=None,
         quarantine_filestore_dao=None,
-        virus_notifications_dao=None
+        virus_notifications_dao=None,
+        parking_queue_dao=None,
+        verdicts_filestore_dao=None,
+        large_files_queue_dao=None
     ):
         super().__init__(
             queue_dao=virus_scanning_queue_dao,
-            logger=logger
+            logger=logger,
+            parking_queue_dao=parking_queue_dao
         )
         self.virus_scanning_queue_dao = virus_scanning_queue_dao
         self.validation_queue_dao = validation_queue_dao
         self.unprocessed_filestore_dao = unprocessed_filestore_dao
         self.quarantine_filestore_dao = quarantine_filestore_dao
         self.virus_notifications_dao = virus_notifications_dao
+        self.large_files_queue_dao = large_files_queue_dao
+        if self.SCAN_ENGINE not in self.SCAN_ENGINES:
+            raise ValueError(f'Unknown scan engine {self.SCAN_ENGINE}. Expected one of {self.SCAN_ENGINES}')
+        # persistent clamd sessions, one per scanning thread for each endpoint
+        self.clamd = ClamdBalancer(
+            pools=[
+                ClamdPool(
+                    clamd=clamd,
+                    size=self.CONCURRENCY,
+                    ping_interval=self.CLAMD_PING_INTERVAL
+                )
+                for clamd in self.get_clamd_endpoints()
+            ],
+            retry_interval=self.CLAMD_RETRY_INTERVAL
+        )
+        self.validation_sender = BatchSender(
+            queue=validation_queue_dao,
+            max_wait=self.FORWARD_BATCH_MAX_WAIT
+        )
+        self.verdict_cache = None
+        if self.VERDICT_CACHE_SIZE:
+            self.verdict_cache = VerdictCache(
+                size=self.VERDICT_CACHE_SIZE,
+                filestore=verdicts_filestore_dao
+            )
+        self.__definitions_version = None
+        self.__definitions_version_time = None
+        self.__published_definitions_version = None
+        self.__published_definitions_version_mtime = None
+        self.__reloading = None
+        self.__reloading_mtime = None
+        self.scratch = ScratchSpace(
+            dir=self.SCRATCH_DIR,
+            budget=self.SCRATCH_SPACE,
+            timeout=self.SCRATCH_TIMEOUT,
+            prefix='scan-'
+        )
+        self.__validator = None
+        if self.VALIDATE:
+            # missing validator settings are reported on startup
+            self.validator
+
+    # downloads the file, runs in a prefetch thread while previous files are scanned
+    def prefetch_message(self, message):
+        if self.SCAN_ENGINE == 'clamd':
+            # files are streamed during the scan
+            return None
+        event = common.event.loads_s3_unprocessed_bucket_object_created_event(message.body)
+        if self.is_large_file(event):
+            # scanned by large files workers
+            return None
+        # each message gets its own file because messages may be scanned in parallel
+        path = self.scratch.reserve(event['s3']['object']['size'])
+        try:
+            sha256 = self.download_file(event, path)
+        except BaseException:
+            self.scratch.release(path)
+            raise
+        return path, sha256
+
+    def discard_prefetch_result(self, message, result):
+        if result is not None:
+            path, sha256 = result
+            self.scratch.release(path)
 
     def process_message(self, message):
         try:
             try:
                 event = common.event.loads_s3_unprocessed_bucket_object_created_event(message.body)
-                self.download_file(event)
-                self.scan_file()
-                self.forward_to_validator(message)
-                self.logger.info(
-                    'File %s is not a virus, event forwarded to validator',
-                    event['s3']['object']['key']
-                )
+                if self.is_large_file(event):
+                    self.forward_to_large_files_queue(message)
+                    self.logger.info(
+                        'File %s is larger than %i bytes, event forwarded to large files queue',
+                        event['s3']['object']['key'],
+                        self.LARGE_FILE_SIZE
+                    )
+                    return True
+                self.scan_message(message, event)
                 return True
             except VirusDetected as e:
                 self.move_to_qurantine(event)
                 self.send_virus_notification(event, str(e))
                 return True
+            except ScanTimeout as e:
+                self.stats['scan_timeouts'] += 1
+                if self.SCAN_TIMEOUT_MAX_TRIES and message.receive_count >= self.SCAN_TIMEOUT_MAX_TRIES:
+                    self.logger.warn(
+                        'Scan of file %s timed out %s times',
+                        event['s3']['object']['key'],
+                        message.receive_count
+                    )
+                    self.stats['scan_timeouts_quarantined'] += 1
+                    self.move_to_qurantine(event)
+                    self.send_virus_notification(event, 'scan timed out')
+                    return True
+                self.logger.error('Scan of file %s timed out', event['s3']['object']['key'], exc_info=True)
+                self.set_failure_reason(message, e)
+                return False
         except common.event.InvalidEventError:
             self.logger.error(message.body, exc_info=True)
             return True
@@ -90,29 +302,281 @@ class VirusScannerWorker(QueuePollingWorker):
                 exc_info=True
             )
             return True
-        except Exception:
+        except Exception as e:
             logger.error('Unexpected error occured', exc_info=True)
+            self.set_failure_reason(message, e)
             return False
 
-    def run_scan_command(self):
-        return subprocess.run(
-            self.VIRUS_SCAN_COMMAND,
-            capture_output=True,
-            encoding='utf8'
-        )
+    # scans the file, then validates it in fused mode or forwards its event to validator
+    def scan_message(self, message, event):
+        path = None
+        try:
+            if self.SCAN_ENGINE == 'clamd' and self.VALIDATE:
+                # streamed content is saved for validation
+                path = self.scratch.reserve(event['s3']['object']['size'])
+                with open(path, 'wb') as copy:
+                    self.stream_file(event, copy, timeout=self.get_scan_timeout(message))
+            elif self.SCAN_ENGINE == 'clamd':
+                self.stream_file(event, timeout=self.get_scan_timeout(message))
+            else:
+                path, sha256 = self.get_prefetched(message)
+                self.scan_file(path, sha256, timeout=self.get_scan_timeout(message))
+            if self.VALIDATE:
+                self.validate_file(event, path)
+            else:
+                self.forward_to_validator(message)
+                self.logger.info(
+                    'File %s is not a virus, event forwarded to validator',
+                    event['s3']['object']['key']
+                )
+        finally:
+            if path is not None:
+                # infected and failed files are removed as well
+                self.scratch.release(path)
+                self.logger.info('Removed scanned file %s', path)
+
+    # validates and archives clean files in fused mode.
+    # Validator module is imported on first use because its settings are required only in this mode
+    @property
+    def validator(self):
+        if self.__validator is None:
+            from worker.validator import ValidatorWorker
+            self.__validator = ValidatorWorker(unprocessed_filestore_dao=self.unprocessed_filestore_dao)
+        return self.__validator
+
+    # moves the clean file to the valid or invalid archive dir
+    def validate_file(self, event, path):
+        with open(path, 'rb') as f:
+            content = f.read()
+        self.logger.info('File %s is not a virus, validating', event['s3']['object']['key'])
+        self.validator.archive_file(event, content)
+
+    def stop(self, timeout=None):
+        super().stop(timeout=timeout)
+        self.validation_sender.close()
+        self.logger.info('clamd endpoints stats: %s', self.clamd.get_stats())
+        self.clamd.close()
+        self.scratch.close()
+
+    # waits until clamd replies to PING and VERSION
+    def wait_until_ready(self):
+        deadline = time.monotonic() + self.CLAMD_STARTUP_TIMEOUT
+        while not self.stopping.is_set():
+            try:
+                if self.clamd.ping():
+                    self.logger.info('clamd is ready. Version: %s', self.clamd.version())
+                    return True
+            except (OSError, ClamdError) as e:
+                self.logger.info('clamd is not ready: %s', e)
+            if time.monotonic() >= deadline:
+                self.logger.error('clamd is not ready in %s seconds', self.CLAMD_STARTUP_TIMEOUT)
+                return False
+            self.stopping.wait(1)
+        return False
+
+    def get_clamd_endpoints(self):
+        if self.CLAMD_ENDPOINTS:
+            return [Clamd.from_endpoint(endpoint, timeout=self.CLAMD_TIMEOUT) for endpoint in self.CLAMD_ENDPOINTS]
+        return [
+            Clamd(
+                socket_path=self.CLAMD_SOCKET,
+                host=self.CLAMD_HOST,
+                port=self.CLAMD_PORT,
+                timeout=self.CLAMD_TIMEOUT
+            )
+        ]
+
+    def get_scan_command(self, path):
+        return [arg.replace('{path}', path) for arg in self.VIRUS_SCAN_COMMAND]
+
+    # the scan command is killed on timeout
+    def run_scan_command(self, path, timeout=None):
+        try:
+            return subprocess.run(
+                self.get_scan_command(path),
+                capture_output=True,
+                encoding='utf8',
+                timeout=timeout
+            )
+        except subprocess.TimeoutExpired as e:
+            raise ScanTimeout(f'Scan is not completed in {timeout} seconds') from e
 
-    def scan_file(self):
-        start_time = datetime.datetime.now()
-        self.logger.info('Scanning downloaded file')
-        result = self.run_scan_command()
+    # max scan time in seconds, None means no limit.
+    # Timed out files get a longer time on each retry
+    def get_scan_timeout(self, message):
+        timeout = None
+        if self.SCAN_TIMEOUT:
+            timeout = self.SCAN_TIMEOUT * 2 ** min(message.receive_count - 1, 16)
+        remaining = self.get_remaining_visibility_timeout(message)
+        if remaining is not None:
+            timeout = remaining if timeout is None else min(timeout, remaining)
+            if timeout <= 0:
+                raise ScanTimeout('Message visibility timeout expired before the scan')
+        return timeout
+
+    # returns signature name if a virus was found and CLEAN otherwise
+    def get_scan_command_verdict(self, result):
+        if result.returncode == 0:
+            return CLEAN
+        if result.returncode == 1:
+            # e.g. /tmp/scan: Eicar-Test-Signature FOUND
+            for line in result.stdout.splitlines():
+                if line.endswith(' FOUND'):
+                    return parse_scan_reply(line)
+            return 'unknown'
+        raise Exception(f'Scan command failed. Exit code: {result.returncode}. Output: {result.stdout}')
+
+    def check_verdict(self, verdict):
+        if verdict != CLEAN:
+            raise VirusDetected(f'virus detected: {verdict}')
+
+    def scan_file(self, path, sha256=None, timeout=None):
+        verdict = self.get_cached_verdict(sha256)
+        if verdict is None:
+            start_time = datetime.datetime.now()
+            self.logger.info('Scanning downloaded file %s', path)
+            result = self.run_scan_command(path, timeout)
+            # NOTE: this log msg is used to help understand performance of the scans
+            self.logger.info('Scan completed in %s seconds', (datetime.datetime.now() - start_time).total_seconds())
+            if result.stderr:
+                raise Exception(result.stderr)
+            verdict = self.get_scan_command_verdict(result)
+            self.cache_verdict(sha256, verdict)
+        else:
+            self.logger.info('Scan skipped, cached verdict of file %s: %s', path, verdict)
+        self.check_verdict(verdict)
+
+    # scans the file streaming it from S3 to clamd, streamed content is also written into copy if it's set
+    def stream_file(self, event, copy=None, timeout=None):
+        obj = event['s3']['object']
+        self.check_file_size(event)
+        body = self.unprocessed_filestore_dao.stream(
+            key=obj['key'],
+            etag=obj['eTag']
+        )
+        try:
+            # object must not be larger than the event says, it's already checked against MAX_FILE_SIZE
+            reader = LimitedReader(body, obj['size'])
+            sha256 = None
+            stream = reader
+            if self.verdict_cache is not None and obj['size'] <= self.VERDICT_CACHE_STREAM_BUFFER_SIZE:
+                # small file is hashed first, it's not scanned if its verdict is known.
+                # Reading one byte more than expected to detect objects larger than the event says
+                data = reader.read(obj['size'] + 1)
+                if copy is not None:
+                    copy.write(data)
+                sha256 = hashlib.sha256(data).hexdigest()
+                verdict = self.get_cached_verdict(sha256)
+                if verdict is not None:
+                    self.logger.info('Scan skipped, cached verdict of file %s: %s', obj['key'], verdict)
+                    self.check_verdict(verdict)
+                    return
+                stream = io.BytesIO(data)
+            elif copy is not None:
+                stream = TeeReader(reader, copy)
+            self.update_reloading_endpoints()
+            start_time = datetime.datetime.now()
+            self.logger.info('Streaming file %s to clamd', obj['key'])
+            try:
+                verdict = self.clamd.instream(
+                    stream,
+                    chunk_size=self.CLAMD_STREAM_CHUNK_SIZE,
+                    timeout=timeout
+                ) or CLEAN
+            except ClamdTimeout as e:
+                raise ScanTimeout(str(e)) from e
+        except FileTooLargeError:
+            self.logger.warn('File %s is larger than %i bytes', obj['key'], obj['size'])
+            raise VirusDetected('file too large')
+        finally:
+            body.close()
         # NOTE: this log msg is used to help understand performance of the scans
         self.logger.info('Scan completed in %s seconds', (datetime.datetime.now() - start_time).total_seconds())
-        if result.stderr:
-            raise Exception(result.stderr)
-        if result.returncode == 1:
-            raise VirusDetected('virus detected')
-        os.remove(self.FILE_SCAN_DOWNLOAD_PATH)
-        self.logger.info('Removed scanned file')
+        self.cache_verdict(sha256, verdict)
+        self.check_verdict(verdict)
+
+    # virus definitions version loaded by clamd, None if it's unknown
+    def get_definitions_version(self):
+        version = self.get_published_definitions_version()
+        if version is not None:
+            return version
+        now = time.monotonic()
+        checked = self.__definitions_version_time
+        if checked is None or now - checked >= self.DEFINITIONS_VERSION_TTL:
+            self.__definitions_version_time = now
+            try:
+                self.__definitions_version = parse_definitions_version(self.clamd.version())
+            except Exception:
+                self.logger.warning('Failed to get virus definitions version, verdict cache is disabled', exc_info=True)
+                self.__definitions_version = None
+        return self.__definitions_version
+
+    # the file is read again only if it's modified, None if there is no published version
+    def get_published_definitions_version(self):
+        if not self.DEFINITIONS_VERSION_FILE:
+            return None
+        try:
+            mtime = os.stat(self.DEFINITIONS_VERSION_FILE).st_mtime_ns
+            if mtime != self.__published_definitions_version_mtime:
+                with open(self.DEFINITIONS_VERSION_FILE) as f:
+                    version = f.read().strip() or None
+                if version != self.__published_definitions_version:
+                    self.logger.info('Virus definitions version %s published', version)
+                self.__published_definitions_version = version
+                self.__published_definitions_version_mtime = mtime
+        except OSError:
+            return None
+        return self.__published_definitions_version
+
+    # takes clamd endpoint reloaded by virus definitions updater out of rotation,
+    # the file is read again only if it's modified
+    def update_reloading_endpoints(self):
+        if not self.DEFINITIONS_VERSION_FILE:
+            return
+        path = f'{self.DEFINITIONS_VERSION_FILE}.reloading'
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            if mtime != self.__reloading_mtime:
+                with open(path) as f:
+                    self.__reloading = json.load(f)
+                self.__reloading_mtime = mtime
+                self.logger.info('clamd %s is reloading', self.__reloading['endpoint'])
+        except FileNotFoundError:
+            self.__reloading = None
+            self.__reloading_mtime = None
+        except (OSError, ValueError):
+            self.logger.warning('Failed to read clamd reload state %s', path, exc_info=True)
+            return
+        reloading = self.__reloading
+        # reload state of the crashed updater expires
+        if reloading is not None and reloading['until'] > time.time():
+            self.clamd.set_reloading([reloading['endpoint']])
+        else:
+            self.clamd.set_reloading([])
+
+    # returns None if the verdict is unknown
+    def get_cached_verdict(self, sha256):
+        if self.verdict_cache is None or sha256 is None:
+            return None
+        version = self.get_definitions_version()
+        if version is None:
+            return None
+        try:
+            return self.verdict_cache.get(sha256, version)
+        except Exception:
+            self.logger.warning('Failed to get cached verdict', exc_info=True)
+            return None
+
+    def cache_verdict(self, sha256, verdict):
+        if self.verdict_cache is None or sha256 is None:
+            return
+        version = self.get_definitions_version()
+        if version is None:
+            return
+        try:
+            self.verdict_cache.put(sha256, version, verdict)
+        except Exception:
+            self.logger.warning('Failed to cache verdict', exc_info=True)
 
     def send_virus_notification(self, event, reason):
         key = event['s3']['object']['key']
@@ -120,6 +584,8 @@ class VirusScannerWorker(QueuePollingWorker):
             'key': key,
             'time': event['eventTime'],
             'reason': reason,
+            # SNS JSON message values must be strings
+            'definitions_version': self.get_definitions_version() or 'unknown',
             'default': 'File {} moved to quarantine. Reason: {}.'.format(
                 key,
                 reason
@@ -140,24 +606,60 @@ class VirusScannerWorker(QueuePollingWorker):
         )
         self.logger.info('Virus detected report saved as %s', report_key)
 
-    def download_file(self, event):
+    def check_file_size(self, event):
         obj = event['s3']['object']
-        self.logger.info('Downloading file %s', obj['key'])
         if obj['size'] > self.MAX_FILE_SIZE:
             self.logger.warn('File %s is too large, %i bytes', obj['key'], obj['size'])
             raise VirusDetected('file too large')
-        self.unprocessed_filestore_dao.download(
-            key=obj['key'],
-            path=self.FILE_SCAN_DOWNLOAD_PATH,
-            etag=obj['eTag']
-        )
+
+    def download_file(self, event, path):
+        obj = event['s3']['object']
+        self.logger.info('Downloading file %s', obj['key'])
+        self.check_file_size(event)
+        hasher = hashlib.sha256()
+        try:
+            # object must not be larger than the event says, it's already checked against MAX_FILE_SIZE
+            self.unprocessed_filestore_dao.download(
+                key=obj['key'],
+                path=path,
+                etag=obj['eTag'],
+                hasher=hasher,
+                max_size=obj['size']
+            )
+        except FileTooLargeError:
+            self.logger.warn('File %s is larger than %i bytes', obj['key'], obj['size'])
+            raise VirusDetected('file too large')
         self.logger.info('Downloaded file %s', obj['key'])
+        return hasher.hexdigest()
 
-    def forward_to_validator(self, message):
-        self.validation_queue_dao.post(
+    # large files are routed only if the worker has the large files queue to route them to
+    def is_large_file(self, event):
+        return (
+            self.large_files_queue_dao is not None
+            and self.LARGE_FILE_SIZE
+            and event['s3']['object']['size'] > self.LARGE_FILE_SIZE
+        )
+
+    def forward_to_large_files_queue(self, message):
+        self.large_files_queue_dao.post(
             body=message.body,
             delay=0
         )
+        self.stats['messages_routed'] += 1
+
+    # the event must be sent before the message is deleted
+    def forward_to_validator(self, message):
+        if self.CONCURRENCY > 1:
+            self.validation_sender.post(
+                body=message.body,
+                delay=0
+            ).result()
+        else:
+            # nothing to batch with
+            self.validation_queue_dao.post(
+                body=message.body,
+                delay=0
+            )
 
     def move_to_qurantine(self, event):
         obj = event['s3']['object']
@@ -173,14 +675,50 @@ class VirusScannerWorker(QueuePollingWorker):
         )
 
 
-if __name__ == '__main__':
+# scans files larger than LARGE_FILE_SIZE received from the large files queue,
+# has its own visibility timeout and concurrency so large files have a separate lane
+class LargeFilesVirusScannerWorker(VirusScannerWorker):
+
+    MESSAGE_VISIBILITY_TIMEOUT = int(os.environ.get(
+        'VIRUS_SCANNER_WORKER_LARGE_FILES_MSG_VISIBILITY_TIMEOUT',
+        VirusScannerWorker.MESSAGE_VISIBILITY_TIMEOUT
+    ))
+    MESSAGE_BATCH_SIZE = int(os.environ.get('VIRUS_SCANNER_WORKER_LARGE_FILES_MSG_BATCH_SIZE', 1))
+    CONCURRENCY = int(os.environ.get('VIRUS_SCANNER_WORKER_LARGE_FILES_CONCURRENCY', 1))
+    PREFETCH_DEPTH = int(os.environ.get('VIRUS_SCANNER_WORKER_LARGE_FILES_PREFETCH_DEPTH', 0))
+
+
+def create_worker():
     s3_connection_data = get_s3_env_conf()
     sqs_connection_data = get_sqs_env_conf()
     sns_connection_data = get_sns_env_conf()
-    VirusScannerWorker(
-        virus_scanning_queue_dao=queue.VirusScanning(sqs_connection_data),
+    if TIER == 'large':
+        # large files workers don't route events any further
+        worker_class = LargeFilesVirusScannerWorker
+        virus_scanning_queue_dao = queue.VirusScanningLargeFiles(sqs_connection_data)
+        large_files_queue_dao = None
+    else:
+        worker_class = VirusScannerWorker
+        virus_scanning_queue_dao = queue.VirusScanning(sqs_connection_data)
+        large_files_queue_dao = (
+            queue.VirusScanningLargeFiles(sqs_connection_data) if VIRUS_SCANNING_LARGE_FILES_QUEUE else None
+        )
+    return worker_class(
+        virus_scanning_queue_dao=virus_scanning_queue_dao,
         validation_queue_dao=queue.Validation(sqs_connection_data),
         unprocessed_filestore_dao=filestore.Unprocessed(s3_connection_data),
         quarantine_filestore_dao=filestore.Quarantine(s3_connection_data),
-        virus_notifications_dao=notifications.Virus(sns_connection_data)
+        virus_notifications_dao=notifications.Virus(sns_connection_data),
+        parking_queue_dao=queue.Parking(sqs_connection_data) if PARKING_QUEUE else None,
+        verdicts_filestore_dao=filestore.Verdicts(s3_connection_data) if VERDICT_CACHE_BUCKET else None,
+        large_files_queue_dao=large_files_queue_dao
+    )
+
+
+if __name__ == '__main__':
+    WorkerSupervisor(
+        worker_factory=create_worker,
+        processes=int(os.environ.get('VIRUS_SCANNER_WORKER_PROCESSES', 0)),
+        max_messages=int(os.environ.get('VIRUS_SCANNER_WORKER_MAX_MESSAGES_PER_PROCESS', 0)),
+        max_memory=int(os.environ.get('VIRUS_SCANNER_WORKER_MAX_MEMORY_PER_PROCESS', 0))
     ).start()
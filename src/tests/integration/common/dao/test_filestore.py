@@ -1,6 +1,10 @@
+import io
 import os
+import hashlib
+import tempfile
 import pytest
-from common.dao.filestore import FileStore, FileChangedError
+from unittest import mock
+from common.dao.filestore import FileStore, FileChangedError, FileTooLargeError
 from tests.integration.conftest import (
     ARCHIVE_BUCKET,
     UNPROCESSED_BUCKET,
@@ -44,6 +48,12 @@ def test(clear_tmp, clear_buckets):
         assert etag_fileobj is not None
         assert etag_fileobj['Body'].read() == content
 
+        body = filestore.stream(key=key, etag=etag)
+        assert body.read(4) + body.read() == content
+        body.close()
+        with pytest.raises(FileChangedError):
+            filestore.stream(key=key, etag='Invalid etag')
+
         try:
             os.remove(DOWNLOAD_PATH)
         except FileNotFoundError:
@@ -65,6 +75,28 @@ def test(clear_tmp, clear_buckets):
             )
         assert not os.path.exists(DOWNLOAD_PATH)
 
+        # hash and progress are reported during the download
+        hasher = hashlib.sha256()
+        progress = []
+        filestore.download(
+            path=DOWNLOAD_PATH,
+            key=key,
+            hasher=hasher,
+            callback=progress.append,
+            max_size=len(content)
+        )
+        assert hasher.hexdigest() == hashlib.sha256(content).hexdigest()
+        assert sum(progress) == len(content)
+        os.remove(DOWNLOAD_PATH)
+        # download stops when the file is larger than expected
+        with pytest.raises(FileTooLargeError):
+            filestore.download(
+                path=DOWNLOAD_PATH,
+                key=key,
+                max_size=len(content) - 1
+            )
+        assert not os.path.exists(DOWNLOAD_PATH)
+
     # prefix key must end with /
     with pytest.raises(ValueError):
         filestore.download(
@@ -83,11 +115,15 @@ def test(clear_tmp, clear_buckets):
         )
     os.remove(DOWNLOAD_PATH)
 
-    filestore.download(
+    stats = filestore.download(
         path=RECURSIVE_DOWNLOAD_PATH,
         key='valid/',
-        recursive=True
+        recursive=True,
+        max_workers=2
     )
+    assert stats.files == len(FILES)
+    assert stats.bytes == sum(len(body) for body in FILES.values())
+    assert stats.seconds > 0
 
     files = []
     for dirpath, dirnames, filenames in os.walk(RECURSIVE_DOWNLOAD_PATH):
@@ -100,6 +136,19 @@ def test(clear_tmp, clear_buckets):
             assert f.read() == filestore.get(key=key)['Body'].read()
         os.remove(filename)
 
+    # listing waits for completed downloads
+    with mock.patch('common.dao.filestore.TRANSFER_QUEUE_FACTOR', 1):
+        stats = filestore.download(
+            path=RECURSIVE_DOWNLOAD_PATH,
+            key='valid/',
+            recursive=True,
+            max_workers=1
+        )
+    assert stats.files == len(FILES)
+    for filename in files:
+        assert os.path.isfile(filename)
+        os.remove(filename)
+
     copy_key, move_key, *rest = FILES.keys()
     target_copy_key = 'copy.txt'
     target_move_key = 'move.txt'
@@ -178,6 +227,47 @@ def test_bulk_delete(clear_buckets):
         assert filestore.delete(recursive=True, key=prefix) == len(FILES)
 
 
+class FailingReader(io.BytesIO):
+
+    def read(self, *args, **kwargs):
+        if self.tell() >= 6 * 1024 * 1024:
+            raise OSError('read failed')
+        return super().read(*args, **kwargs)
+
+
+def test_upload(clear_buckets):
+    clear_buckets()
+    filestore = FileStore(
+        bucket=BUCKET,
+        connection_conf=S3_CONNECTION_DATA
+    )
+    part_size = 5 * 1024 * 1024
+    for size in [10, 2 * part_size + 10]:
+        body = os.urandom(size)
+        stats = filestore.upload(key='upload', fileobj=io.BytesIO(body), part_size=part_size, max_workers=2)
+        assert stats.files == 1
+        assert stats.bytes == size
+        assert filestore.get(key='upload')['Body'].read() == body
+    # multipart upload object etag has number of parts suffix
+    assert filestore.head(key='upload')['ETag'].endswith('-3"')
+
+    # file is uploaded by path
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(body)
+        f.flush()
+        stats = filestore.upload(key='upload-path', path=f.name, part_size=part_size, max_workers=2)
+    assert stats.bytes == len(body)
+    assert filestore.get(key='upload-path')['Body'].read() == body
+    assert filestore.head(key='upload-path')['ETag'].endswith('-3"')
+
+    # incomplete upload is aborted
+    with pytest.raises(OSError):
+        filestore.upload(key='failed', fileobj=FailingReader(os.urandom(3 * part_size)), part_size=part_size)
+    assert filestore.head(key='failed') is None
+    uploads = filestore.s3.meta.client.list_multipart_uploads(Bucket=filestore.bucket.name)
+    assert not uploads.get('Uploads')
+
+
 def test_list(clear_buckets):
     clear_buckets()
     filestore = FileStore(
@@ -207,3 +297,20 @@ def test_list(clear_buckets):
         assert key in files
         assert filestore.get(key)['Body'].read() == files[key]
     assert listed_count == len(files)
+    # metadata only listing
+    summaries = list(filestore.list_objects(key='b/a'))
+    assert sorted(summary.key for summary in summaries) == ['b/a/1', 'b/a/2', 'b/a/3']
+    for summary in summaries:
+        fileobj = filestore.get(summary.key)
+        assert summary.size == len(files[summary.key])
+        assert summary.etag == fileobj['ETag']
+        assert summary.last_modified.replace(microsecond=0) == fileobj['LastModified']
+    assert len(list(filestore.list_objects())) == len(files)
+    assert not list(filestore.list_objects(key='c'))
+    # head doesn't return body
+    head = filestore.head(key='a/b/1')
+    assert 'Body' not in head
+    assert head['ContentLength'] == len(files['a/b/1'])
+    assert filestore.head(key='a/b/1', etag=head['ETag'])['ETag'] == head['ETag']
+    assert filestore.head(key='a/b/1', etag='"wrong"') is None
+    assert filestore.head(key='a/b/3') is None
@@ -1,4 +1,5 @@
 import time
+import pytest
 from common.dao.queue import Queue
 from tests.integration.conftest import (
     SQS_CONNECTION_DATA,
@@ -66,3 +67,71 @@ def test(clear_queues):
     assert not queue.get(wait_time=1)
 
     # assert not queue.delete(id='Invalid', receipt_handle='Invalid')
+
+
+def test_batch(clear_queues):
+    clear_queues()
+    queue = Queue(
+        queue=VALIDATION_QUEUE,
+        connection_conf=SQS_CONNECTION_DATA
+    )
+    with pytest.raises(ValueError):
+        queue.get_many(max_messages=0)
+    with pytest.raises(ValueError):
+        queue.get_many(max_messages=11)
+    assert queue.get_many(wait_time=1) == []
+
+    bodies = [f'message-{index}' for index in range(15)]
+    for body in bodies:
+        queue.post(body=body, delay=0)
+
+    received = []
+    while len(received) < len(bodies):
+        messages = queue.get_many(max_messages=10, visibility_timeout=10, wait_time=1)
+        assert messages
+        assert len(messages) <= 10
+        received += messages
+    assert sorted(message.body for message in received) == sorted(bodies)
+    # more than 10 messages are split into several delete calls
+    assert queue.delete_many(messages=received) == []
+    assert queue.get(wait_time=1) is None
+
+
+def test_change_visibility(clear_queues):
+    clear_queues()
+    queue = Queue(
+        queue=VALIDATION_QUEUE,
+        connection_conf=SQS_CONNECTION_DATA
+    )
+    for body in ['one', 'two']:
+        queue.post(body=body, delay=0)
+    messages = queue.get_many(max_messages=2, visibility_timeout=1, wait_time=1)
+    assert len(messages) == 2
+    assert all(message.receive_count == 1 for message in messages)
+    # extended messages must stay invisible after initial visibility timeout
+    assert queue.change_visibility_many(messages=messages, timeout=5) == []
+    time.sleep(1.5)
+    assert queue.get(wait_time=0) is None
+    # released messages must become visible right away
+    assert queue.change_visibility_many(messages=messages, timeout=0) == []
+    messages = queue.get_many(max_messages=2, wait_time=1)
+    assert sorted(message.body for message in messages) == ['one', 'two']
+    assert all(message.receive_count == 2 for message in messages)
+    assert queue.delete_many(messages=messages) == []
+
+
+def test_post_many(clear_queues):
+    clear_queues()
+    queue = Queue(
+        queue=VALIDATION_QUEUE,
+        connection_conf=SQS_CONNECTION_DATA
+    )
+    bodies = [f'message-{index}' for index in range(15)]
+    assert queue.post_many(messages=[dict(body=body, delay=0) for body in bodies]) == []
+    received = []
+    while len(received) < len(bodies):
+        messages = queue.get_many(max_messages=10, wait_time=1)
+        assert messages
+        received += messages
+    assert sorted(message.body for message in received) == sorted(bodies)
+    assert queue.delete_many(messages=received) == []
@@ -146,8 +146,13 @@ def test_exception_cases(get_utc_now, clear_queues, clear_buckets):
     assert event_time == file['LastModified'].astimezone(LOCAL_TZ).isoformat()
     assert event_name == "ObjectCreated:Put"
 
-    # testing FileMovedError
+    # testing that events are created from the listing without per object requests
     unprocessed_filestore_dao.get = mock.MagicMock()
-    unprocessed_filestore_dao.get.return_value = None
+    unprocessed_filestore_dao.head = mock.MagicMock()
     worker.start()
-    assert virus_scanning_queue_dao.get(wait_time=1) is None
+    msg = virus_scanning_queue_dao.get(wait_time=1)
+    assert msg
+    virus_scanning_queue_dao.delete(msg)
+    assert json.loads(msg.body)['Records'][0]['s3']['object']['eTag'] == etag
+    unprocessed_filestore_dao.get.assert_not_called()
+    unprocessed_filestore_dao.head.assert_not_called()
@@ -1,4 +1,5 @@
 # simple test just to check that worker runs
+import json
 import os
 import time
 from unittest import mock
@@ -10,8 +11,9 @@ def test():
     VirusDefinitionsUpdater().run()
 
 
+@mock.patch.object(VirusDefinitionsUpdater, 'reload_clamd')
 @mock.patch('processor.worker.virus_definitions_updater.subprocess.Popen')
-def test_mocked(Popen):
+def test_mocked(Popen, reload_clamd):
 
     VIRUS_DEFINITIONS_DIR = tempfile.mkdtemp()
     VIRUS_DEFINITION_FILES = 'definitions-monthly,definitions-daily'
@@ -54,18 +56,23 @@ def test_mocked(Popen):
         assert VirusDefinitionsUpdater().run()
         Popen.assert_called_once()
         Popen.reset_mock()
+        reload_clamd.assert_not_called()
         # testing success files updated
         process_mock.returncode = 0
         Popen.side_effect = create_update_files
         assert VirusDefinitionsUpdater().run()
         Popen.assert_called_once()
         Popen.reset_mock()
+        # clamd reloads updated definitions, daily database changes the version
+        reload_clamd.assert_called_once_with(wait_for_version=True)
+        reload_clamd.reset_mock()
         # testing no updater error, but files not updated
         # NOTE: should not be considered an error
         Popen.side_effect = None
         assert VirusDefinitionsUpdater().run()
         Popen.assert_called_once()
         Popen.reset_mock()
+        reload_clamd.assert_not_called()
         # testing missing env var VIRUS_DEFINITIONS_DIR
         with mock.patch.dict('os.environ'):
             del os.environ['VIRUS_DEFINITIONS_DIR']
@@ -86,3 +93,64 @@ def test_mocked(Popen):
             assert not VirusDefinitionsUpdater().run()
             Popen.assert_not_called()
             Popen.reset_mock()
+
+
+def test_reload_clamd():
+    clamd = mock.MagicMock()
+    clamd.name = '/var/run/clamav/clamd.sock'
+    clamd.version.side_effect = [
+        'ClamAV 0.102.4/25000/Mon Oct 19 12:00:00 2026',
+        'ClamAV 0.102.4/25001/Tue Oct 20 12:00:00 2026'
+    ]
+    with tempfile.TemporaryDirectory() as dirname:
+        version_file = os.path.join(dirname, 'version')
+        updater = VirusDefinitionsUpdater()
+        updater.CLAMD_ENDPOINTS = ['/var/run/clamav/clamd.sock']
+        updater.VERSION_FILE = version_file
+        reloading = []
+
+        def reload():
+            # scanners are told which endpoint is reloading
+            with open(f'{version_file}.reloading') as f:
+                reloading.append(json.load(f))
+        clamd.reload.side_effect = reload
+        with mock.patch('processor.worker.virus_definitions_updater.Clamd') as Clamd:
+            Clamd.from_endpoint.return_value = clamd
+            updater.reload_clamd()
+        clamd.reload.assert_called_once()
+        with open(version_file) as f:
+            assert f.read() == '25001'
+        assert reloading[0]['endpoint'] == clamd.name
+        assert reloading[0]['until'] > time.time()
+        assert not os.path.exists(f'{version_file}.reloading')
+
+        # version is not published if clamd can't be reloaded, other endpoints are reloaded anyway
+        os.remove(version_file)
+        clamd.version.side_effect = ConnectionRefusedError()
+        other = mock.MagicMock()
+        other.name = 'clamd:3310'
+        other.version.side_effect = [
+            'ClamAV 0.102.4/25001/Tue Oct 20 12:00:00 2026',
+            'ClamAV 0.102.4/25002/Wed Oct 21 12:00:00 2026'
+        ]
+        updater.CLAMD_ENDPOINTS = ['/var/run/clamav/clamd.sock', 'clamd:3310']
+        with mock.patch('processor.worker.virus_definitions_updater.Clamd') as Clamd:
+            Clamd.from_endpoint.side_effect = [clamd, other]
+            updater.reload_clamd()
+        other.reload.assert_called_once()
+        assert not os.path.exists(version_file)
+
+        # version stays the same if the daily database was not updated, clamd replying to PING is enough
+        clamd.version.side_effect = None
+        clamd.version.return_value = 'ClamAV 0.102.4/25002/Wed Oct 21 12:00:00 2026'
+        clamd.ping.reset_mock()
+        clamd.ping.side_effect = [ConnectionRefusedError(), True]
+        updater.CLAMD_ENDPOINTS = ['/var/run/clamav/clamd.sock']
+        start_time = time.monotonic()
+        with mock.patch('processor.worker.virus_definitions_updater.Clamd') as Clamd:
+            Clamd.from_endpoint.return_value = clamd
+            updater.reload_clamd(wait_for_version=False)
+        assert time.monotonic() - start_time < updater.CLAMD_RELOAD_TIMEOUT / 2
+        assert clamd.ping.call_count == 2
+        with open(version_file) as f:
+            assert f.read() == '25002'
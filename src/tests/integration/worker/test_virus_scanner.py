@@ -8,6 +8,7 @@ from processor.dao import (
 )
 from processor.worker.virus_scanner import VirusScannerWorker
 from tests.integration.conftest import (
+    event_filename_to_archive_key,
     event_filename_to_unprocessed_key
 )
 
@@ -146,3 +147,70 @@ def test(fill_unprocessed_bucket, clear_queues, clear_buckets, clear_tmp):
     assert quarantine_filestore_dao.get(
         key=event_filename_to_report_key(filename)
     )
+
+
+def validate(scan_engine, fill_unprocessed_bucket, clear_queues, clear_buckets, clear_tmp):
+    clear_tmp()
+    clear_queues()
+    clear_buckets()
+
+    unprocessed_bucket_events = fill_unprocessed_bucket()
+    virus_scanning_queue_dao = queue.VirusScanning(
+        conf.get_sqs_env_conf()
+    )
+    validation_queue_dao = queue.Validation(
+        conf.get_sqs_env_conf()
+    )
+    unprocessed_filestore_dao = filestore.Unprocessed(
+        conf.get_s3_env_conf()
+    )
+    archive_filestore_dao = filestore.Archive(
+        conf.get_s3_env_conf()
+    )
+    worker = VirusScannerWorker(
+        virus_scanning_queue_dao=virus_scanning_queue_dao,
+        validation_queue_dao=validation_queue_dao,
+        unprocessed_filestore_dao=unprocessed_filestore_dao,
+        quarantine_filestore_dao=filestore.Quarantine(
+            conf.get_s3_env_conf()
+        ),
+        virus_notifications_dao=notifications.Virus(
+            conf.get_sns_env_conf()
+        )
+    )
+    worker.VALIDATE = True
+    worker.SCAN_ENGINE = scan_engine
+    # streamed files are not hashed in memory, so their content is saved for validation while streaming
+    worker.VERDICT_CACHE_STREAM_BUFFER_SIZE = 0
+    worker.MESSAGE_VISIBILITY_TIMEOUT = 0
+    worker.MESSAGE_WAIT_TIME = 0
+
+    put = unprocessed_bucket_events['put']
+    for filename, valid in [
+        ('2019-1-2-0-user-valid.json', True),
+        ('2019-1-1-0-user-invalid.json', False)
+    ]:
+        virus_scanning_queue_dao.post(
+            body=json.dumps(put[filename]),
+            delay=0
+        )
+        assert next(worker)
+        # file is archived by the scanner, validator is not involved
+        assert not validation_queue_dao.get(wait_time=1)
+        assert archive_filestore_dao.get(
+            key=posixpath.join(
+                conf.ARCHIVE_BUCKET_VALID_DIR if valid else conf.ARCHIVE_BUCKET_INVALID_DIR,
+                event_filename_to_archive_key(filename)
+            )
+        )
+        assert not unprocessed_filestore_dao.get(
+            key=event_filename_to_unprocessed_key(filename)
+        )
+
+
+def test_validate(fill_unprocessed_bucket, clear_queues, clear_buckets, clear_tmp):
+    validate('clamdscan', fill_unprocessed_bucket, clear_queues, clear_buckets, clear_tmp)
+
+
+def test_validate_clamd(fill_unprocessed_bucket, clear_queues, clear_buckets, clear_tmp):
+    validate('clamd', fill_unprocessed_bucket, clear_queues, clear_buckets, clear_tmp)
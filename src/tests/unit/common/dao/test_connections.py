@@ -0,0 +1,86 @@
+import threading
+from processor.common.dao import connections
+
+
+def test_get_resource():
+    connections.clear_connections()
+    connection_conf = {
+        "aws_access_key_id": "access",
+        "aws_secret_access_key": "secret",
+        "endpoint_url": "http://localhost:9000",
+        "region_name": "us-east-1"
+    }
+    s3 = connections.get_resource('s3', **connection_conf)
+    # resources are created per call and share the client by service and connection parameters
+    assert connections.get_resource('s3', **connection_conf) is not s3
+    assert connections.get_resource('s3', **connection_conf).meta.client is s3.meta.client
+    assert connections.get_client('s3', **connection_conf) is s3.meta.client
+    assert connections.get_resource('sqs', **connection_conf).meta.client is not s3.meta.client
+    assert connections.get_client(
+        's3',
+        **{**connection_conf, 'endpoint_url': 'http://localhost:9001'}
+    ) is not s3.meta.client
+    # sessions are reused by credentials
+    assert connections.get_session(
+        aws_access_key_id="access",
+        aws_secret_access_key="secret",
+        region_name="us-east-1"
+    ) is connections.get_session(
+        aws_access_key_id="access",
+        aws_secret_access_key="secret",
+        region_name="us-east-1"
+    )
+    config = s3.meta.client.meta.config
+    assert config.max_pool_connections == connections.AWS_MAX_POOL_CONNECTIONS
+    assert config.tcp_keepalive == connections.AWS_TCP_KEEPALIVE
+    assert config.retries['mode'] == connections.AWS_RETRY_MODE
+    assert config.connect_timeout == connections.AWS_CONNECT_TIMEOUT
+    assert config.read_timeout == connections.AWS_READ_TIMEOUT
+    assert s3.Bucket('bucket').name == 'bucket'
+    connections.clear_connections()
+    assert connections.get_client('s3', **connection_conf) is not s3.meta.client
+
+
+def test_dao_resources_per_thread():
+    from processor.common.dao.filestore import FileStore
+    connections.clear_connections()
+    filestore = FileStore(bucket='bucket', connection_conf={
+        "aws_access_key_id": "access",
+        "aws_secret_access_key": "secret",
+        "region_name": "us-east-1"
+    })
+    resources = []
+
+    def get_resources():
+        resources.append((filestore.s3, filestore.bucket))
+    thread = threading.Thread(target=get_resources)
+    thread.start()
+    thread.join()
+    get_resources()
+    get_resources()
+    assert resources[1] == resources[2]
+    assert resources[0][0] is not resources[1][0]
+    assert resources[0][1] is not resources[1][1]
+    assert resources[0][0].meta.client is resources[1][0].meta.client
+    connections.clear_connections()
+
+
+def test_thread_local_property():
+    class DAO:
+        calls = 0
+
+        @connections.thread_local_property
+        def resource(self):
+            DAO.calls += 1
+            return object()
+
+    dao = DAO()
+    other = DAO()
+    resources = []
+    thread = threading.Thread(target=lambda: resources.append(dao.resource))
+    thread.start()
+    thread.join()
+    assert dao.resource is dao.resource
+    assert dao.resource is not resources[0]
+    assert other.resource is not dao.resource
+    assert DAO.calls == 3
@@ -0,0 +1,81 @@
+import threading
+from unittest import mock
+import pytest
+from processor.common.dao.filestore import FileStore, DeleteError
+
+
+@mock.patch('processor.common.dao.filestore.time.sleep')
+@mock.patch('processor.common.dao.filestore.get_resource')
+def test_delete_many(get_resource, sleep):
+    filestore = FileStore(bucket='test', connection_conf={})
+    bucket = get_resource.return_value.Bucket.return_value
+    calls = []
+
+    def delete_objects(Delete=None):
+        keys = [item['Key'] for item in Delete['Objects']]
+        calls.append(keys)
+        # fails only on the first attempt
+        if len(calls) == 1:
+            return dict(Errors=[dict(Key='retry', Code='InternalError', Message='Internal error')])
+        return dict()
+    bucket.delete_objects.side_effect = delete_objects
+
+    assert filestore.delete_many(['one', 'retry', 'two']) == 3
+    # only failed keys are retried
+    assert calls == [['one', 'retry', 'two'], ['retry']]
+    sleep.assert_called_once()
+
+    # error is raised once retries are exhausted
+    bucket.delete_objects.side_effect = None
+    bucket.delete_objects.return_value = dict(
+        Errors=[dict(Key='denied', Code='AccessDenied', Message='Access Denied')]
+    )
+    bucket.delete_objects.reset_mock()
+    with pytest.raises(DeleteError) as e:
+        filestore.delete_many(['one', 'denied'], retries=2)
+    assert 'denied AccessDenied' in str(e.value)
+    assert bucket.delete_objects.call_count == 3
+
+
+@mock.patch('processor.common.dao.filestore.time.sleep')
+@mock.patch('processor.common.dao.filestore.get_resource')
+def test_delete_recursive(get_resource, sleep):
+    filestore = FileStore(bucket='test', connection_conf={})
+    bucket = get_resource.return_value.Bucket.return_value
+    pages = [
+        [mock.MagicMock(key=f'prefix/{page}/{index}') for index in range(size)]
+        for page, size in enumerate([3, 0, 2, 1])
+    ]
+    bucket.objects.filter.return_value.pages.return_value = pages
+    lock = threading.Lock()
+    attempts = dict()
+
+    def delete_objects(Delete=None):
+        keys = [item['Key'] for item in Delete['Objects']]
+        errors = []
+        with lock:
+            for key in keys:
+                attempts[key] = attempts.get(key, 0) + 1
+                # first key of each page fails once
+                if key.endswith('/0') and attempts[key] == 1:
+                    errors.append(dict(Key=key, Code='SlowDown', Message='Reduce your request rate'))
+        return dict(Errors=errors)
+    bucket.delete_objects.side_effect = delete_objects
+
+    assert filestore.delete(key='prefix/', recursive=True, max_workers=2) == 6
+    bucket.objects.filter.assert_called_once_with(Prefix='prefix/')
+    # empty page is skipped, failed keys are retried
+    assert bucket.delete_objects.call_count == 6
+    assert attempts == {
+        'prefix/0/0': 2, 'prefix/0/1': 1, 'prefix/0/2': 1,
+        'prefix/2/0': 2, 'prefix/2/1': 1,
+        'prefix/3/0': 2
+    }
+
+    # page which can't be deleted fails the whole delete
+    bucket.delete_objects.side_effect = None
+    bucket.delete_objects.return_value = dict(
+        Errors=[dict(Key='prefix/0/0', Code='AccessDenied', Message='Access Denied')]
+    )
+    with pytest.raises(DeleteError):
+        filestore.delete(key='prefix/', recursive=True, max_workers=2, retries=1)
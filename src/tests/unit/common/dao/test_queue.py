@@ -0,0 +1,119 @@
+import threading
+from unittest import mock
+import pytest
+from processor.common.dao.queue import (
+    BatchSender,
+    Queue,
+    SendError,
+    MAX_BATCH_PAYLOAD_SIZE
+)
+
+
+@mock.patch('processor.common.dao.queue.get_resource')
+def test_post_many(get_resource):
+    queue = Queue(queue='test', connection_conf={})
+    sqs_queue = get_resource.return_value.Queue.return_value
+    calls = []
+
+    def send_messages(Entries=None):
+        calls.append([entry['MessageBody'] for entry in Entries])
+        failed = []
+        for entry in Entries:
+            if entry['MessageBody'] == 'invalid':
+                failed.append(dict(Id=entry['Id'], SenderFault=True, Code='InvalidParameterValue'))
+            # fails only on the first attempt
+            elif entry['MessageBody'] == 'retry' and len(calls) == 1:
+                failed.append(dict(Id=entry['Id'], SenderFault=False, Code='InternalError'))
+        return dict(Failed=failed)
+    sqs_queue.send_messages.side_effect = send_messages
+
+    messages = [dict(body=body, delay=0) for body in ['retry', 'invalid'] + [str(i) for i in range(10)]]
+    failed = queue.post_many(messages=messages)
+    assert [(message['body'], entry['Code']) for message, entry in failed] == [('invalid', 'InvalidParameterValue')]
+    # 10 entries per call, sender faults are not retried
+    assert calls[0] == ['retry', 'invalid'] + [str(i) for i in range(8)]
+    assert calls[1:] == [['retry'], ['8', '9']]
+
+    # payload size limit
+    large = 'x' * (MAX_BATCH_PAYLOAD_SIZE // 2 + 1)
+    assert [len(batch) for batch in queue.split_batches([dict(body=large)] * 3)] == [1, 1, 1]
+    assert [len(batch) for batch in queue.split_batches([dict(body='x')] * 25)] == [10, 10, 5]
+
+
+def test_batch_sender():
+    queue = mock.MagicMock()
+    batches = []
+
+    def post_many(messages=None, retries=None):
+        batches.append([message['body'] for message in messages])
+        return [(message, dict(Code='InternalError')) for message in messages if message['body'] == 'fail']
+    queue.post_many.side_effect = post_many
+
+    sender = BatchSender(queue=queue, max_wait=10)
+    # full batch is sent without waiting
+    results = [sender.post(body=str(i)) for i in range(10)]
+    assert all(future.result(timeout=5) for future in results)
+    assert batches == [[str(i) for i in range(10)]]
+
+    # concurrent posts are sent in one batch
+    sender.max_wait = 0.2
+    posted = []
+    threads = [
+        threading.Thread(target=lambda body=body: posted.append(sender.post(body=body)))
+        for body in ['one', 'fail', 'two']
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for future in posted:
+        try:
+            future.result(timeout=5)
+        except SendError:
+            pass
+    assert sorted(batches[1]) == ['fail', 'one', 'two']
+    assert sum(1 for future in posted if future.exception()) == 1
+
+    # close sends buffered messages right away
+    sender.max_wait = 10
+    future = sender.post(body='last')
+    sender.close()
+    assert future.done() and future.result()
+    # sender can be used after close
+    future = sender.post(body='next')
+    sender.close()
+    assert future.result()
+
+    queue.post_many.side_effect = Exception('error')
+    future = sender.post(body='error')
+    sender.close()
+    with pytest.raises(Exception):
+        future.result()
+
+
+def test_batch_sender_backpressure():
+    queue = mock.MagicMock()
+    sending = threading.Event()
+    finish = threading.Event()
+
+    def post_many(messages=None, retries=None):
+        sending.set()
+        finish.wait(5)
+        return []
+    queue.post_many.side_effect = post_many
+
+    sender = BatchSender(queue=queue, max_wait=10, max_buffered_batches=1)
+    results = [sender.post(body=str(i)) for i in range(10)]
+    assert sending.wait(5)
+    # the first batch is being sent, the next one is buffered
+    results += [sender.post(body=str(i)) for i in range(10, 20)]
+    thread = threading.Thread(target=lambda: results.append(sender.post(body='blocked')))
+    thread.start()
+    thread.join(0.2)
+    assert thread.is_alive()
+    finish.set()
+    thread.join(5)
+    assert not thread.is_alive()
+    sender.close()
+    assert len(results) == 21
+    assert all(future.result(timeout=5) for future in results)
@@ -0,0 +1,259 @@
+import io
+import os
+import socket
+import struct
+import time
+import tempfile
+import threading
+import pytest
+from processor.common.clamd import (
+    Clamd,
+    ClamdPool,
+    ClamdBalancer,
+    ClamdError,
+    ClamdTimeout,
+    ClamdConnectionError,
+    parse_scan_reply
+)
+
+
+def recv_exactly(conn, size):
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+
+# minimal clamd speaking z prefixed commands
+class FakeClamd:
+
+    def __init__(self, path, stream_max_length=1024):
+        self.path = path
+        self.stream_max_length = stream_max_length
+        # INSTREAM reply delay in seconds
+        self.delay = 0
+        self.reloads = 0
+        self.chunks = []
+        self.connections = []
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen()
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, address = self.server.accept()
+            except OSError:
+                return
+            self.connections.append(conn)
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        session = False
+        request_id = 0
+        with conn:
+            try:
+                while True:
+                    command = b''
+                    while not command.endswith(b'\0'):
+                        command += recv_exactly(conn, 1)
+                    command = command[1:-1].decode()
+                    if command == 'IDSESSION':
+                        session = True
+                        continue
+                    if command == 'END':
+                        return
+                    request_id += 1
+                    reply = self.reply(conn, command)
+                    prefix = f'{request_id}: '.encode() if session else b''
+                    conn.sendall(prefix + reply + b'\0')
+                    if not session or reply.endswith(b'ERROR'):
+                        return
+            except (EOFError, OSError):
+                return
+
+    def reply(self, conn, command):
+        if command == 'PING':
+            return b'PONG'
+        if command == 'RELOAD':
+            self.reloads += 1
+            return b'RELOADING'
+        if command == 'VERSION':
+            return b'ClamAV 0.102.4/25000/Mon Oct 19 12:00:00 2026'
+        if command == 'INSTREAM':
+            data = b''
+            while True:
+                size, = struct.unpack('!L', recv_exactly(conn, 4))
+                if not size:
+                    break
+                self.chunks.append(size)
+                data += recv_exactly(conn, size)
+                if len(data) > self.stream_max_length:
+                    return b'INSTREAM size limit exceeded. ERROR'
+            time.sleep(self.delay)
+            if b'EICAR' in data:
+                return b'stream: Eicar-Test-Signature FOUND'
+            return b'stream: OK'
+        return b'UNKNOWN COMMAND'
+
+    # drops all the connections like restarted clamd
+    def restart(self):
+        for conn in self.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                # closed already
+                pass
+        self.connections.clear()
+
+    def close(self):
+        self.server.close()
+
+
+@pytest.fixture
+def clamd():
+    with tempfile.TemporaryDirectory() as dirname:
+        server = FakeClamd(os.path.join(dirname, 'clamd.sock'))
+        yield server
+        server.close()
+
+
+def test_parse_scan_reply():
+    assert parse_scan_reply('stream: OK') is None
+    assert parse_scan_reply('stream: Eicar-Test-Signature FOUND') == 'Eicar-Test-Signature'
+    with pytest.raises(ClamdError):
+        parse_scan_reply('INSTREAM size limit exceeded. ERROR')
+    with pytest.raises(ClamdError):
+        parse_scan_reply('UNKNOWN COMMAND')
+
+
+def test_instream(clamd):
+    client = Clamd(socket_path=clamd.path, timeout=5)
+    assert client.ping()
+    assert client.version().startswith('ClamAV')
+    assert client.instream(io.BytesIO(b'{"valid": "json"}')) is None
+    assert client.instream(io.BytesIO(b'x' * 100 + b'EICAR'), chunk_size=10) == 'Eicar-Test-Signature'
+    # file is streamed in chunks
+    assert clamd.chunks[-11:] == [10] * 10 + [5]
+    with pytest.raises(ClamdError):
+        client.instream(io.BytesIO(b'x' * 100000), chunk_size=512)
+
+
+def test_pool(clamd):
+    pool = ClamdPool(
+        clamd=Clamd(socket_path=clamd.path, timeout=5),
+        size=2,
+        ping_interval=0
+    )
+    assert pool.ping()
+    assert pool.version().startswith('ClamAV')
+    assert pool.instream(io.BytesIO(b'EICAR')) == 'Eicar-Test-Signature'
+    # single session is reused by sequential scans
+    assert len(clamd.connections) == 1
+
+    # concurrent scans use separate sessions
+    with pool.session() as one:
+        with pool.session() as two:
+            assert one is not two
+            assert one.instream(io.BytesIO(b'one')) is None
+            assert two.instream(io.BytesIO(b'two')) is None
+    assert len(clamd.connections) == 2
+
+    # broken sessions are replaced after failed PING
+    clamd.restart()
+    assert pool.instream(io.BytesIO(b'valid')) is None
+    assert len(clamd.connections) == 1
+
+    # failed session is not reused
+    with pytest.raises(ClamdError):
+        pool.instream(io.BytesIO(b'x' * 100000), chunk_size=512)
+    assert pool.instream(io.BytesIO(b'valid')) is None
+    assert len(clamd.connections) == 2
+    pool.close()
+
+
+def test_timeout(clamd):
+    client = Clamd(socket_path=clamd.path, timeout=5)
+    pool = ClamdPool(clamd=client, ping_interval=0)
+    assert pool.instream(io.BytesIO(b'valid'), timeout=1) is None
+    clamd.delay = 0.5
+    start = time.monotonic()
+    with pytest.raises(ClamdTimeout):
+        pool.instream(io.BytesIO(b'valid'), timeout=0.1)
+    assert time.monotonic() - start < 0.5
+    with pytest.raises(ClamdTimeout):
+        client.instream(io.BytesIO(b'valid'), timeout=0.1)
+    # timed out session is closed
+    clamd.delay = 0
+    assert pool.instream(io.BytesIO(b'valid'), timeout=1) is None
+    assert len(clamd.connections) == 3
+    pool.close()
+
+
+def test_balancer():
+    with tempfile.TemporaryDirectory() as dirname:
+        one = FakeClamd(os.path.join(dirname, 'one.sock'))
+        two = FakeClamd(os.path.join(dirname, 'two.sock'))
+        balancer = ClamdBalancer(
+            pools=[
+                ClamdPool(clamd=Clamd.from_endpoint(server.path, timeout=5), size=2)
+                for server in [one, two]
+            ],
+            retry_interval=0
+        )
+        # idle endpoints are used in turn
+        for i in range(4):
+            assert balancer.instream(io.BytesIO(b'valid')) is None
+        assert len(one.chunks) == len(two.chunks) == 2
+
+        # busy endpoint is skipped
+        first, second = balancer.endpoints
+        first.outstanding += 1
+        assert balancer.instream(io.BytesIO(b'valid')) is None
+        assert len(two.chunks) == 3
+        first.outstanding -= 1
+
+        # endpoint out of rotation during reload
+        balancer.set_reloading([one.path])
+        assert not first.available
+        for i in range(2):
+            assert balancer.instream(io.BytesIO(b'valid')) is None
+        assert len(one.chunks) == 2
+        assert len(two.chunks) == 5
+        balancer.set_reloading([])
+        assert all(endpoint.available for endpoint in balancer.endpoints)
+
+        # errors of the scanned stream don't take the endpoint out of rotation
+        class FailingStream:
+            def read(self, size=-1):
+                raise TimeoutError('S3 read timed out')
+        with pytest.raises(TimeoutError):
+            balancer.instream(FailingStream())
+        assert all(endpoint.available for endpoint in balancer.endpoints)
+
+        # failed endpoint is out of rotation until it replies to PING
+        one.close()
+        one.restart()
+        os.remove(one.path)
+        with pytest.raises(ClamdConnectionError):
+            for i in range(2):
+                balancer.instream(io.BytesIO(b'valid'))
+        assert not first.available
+        for i in range(4):
+            assert balancer.instream(io.BytesIO(b'valid')) is None
+        assert not first.available
+        one = FakeClamd(one.path)
+        assert balancer.instream(io.BytesIO(b'valid')) is None
+        assert first.available
+
+        stats = balancer.get_stats()
+        assert stats[two.path]['latency']['instream']['count'] >= 9
+        assert stats[two.path]['available']
+        balancer.close()
+        one.close()
+        two.close()
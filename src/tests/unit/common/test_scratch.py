@@ -0,0 +1,40 @@
+import os
+import tempfile
+import threading
+import pytest
+from processor.common.scratch import ScratchSpace, ScratchSpaceExhausted
+
+
+def test_scratch_space():
+    with tempfile.TemporaryDirectory() as dirname:
+        scratch = ScratchSpace(dir=dirname, budget=100, timeout=0.1)
+        one = scratch.reserve(60)
+        two = scratch.reserve(40)
+        # files are unique and created in a private directory
+        assert one != two
+        assert os.path.dirname(one) == scratch.path
+        assert os.path.dirname(scratch.path) == dirname
+        assert scratch.reserved == 100
+        with pytest.raises(ScratchSpaceExhausted):
+            scratch.reserve(1)
+
+        # reservation waits until the space is released
+        with open(one, 'wb') as f:
+            f.write(b'x' * 60)
+        scratch.timeout = 5
+        timer = threading.Timer(0.1, scratch.release, args=(one,))
+        timer.start()
+        three = scratch.reserve(50)
+        timer.join()
+        assert not os.path.exists(one)
+        assert scratch.reserved == 90
+
+        # file larger than the budget can use it alone
+        scratch.release(two)
+        scratch.release(three)
+        assert scratch.reserved == 0
+        scratch.release(scratch.reserve(1000))
+
+        path = scratch.path
+        scratch.close()
+        assert not os.path.exists(path)
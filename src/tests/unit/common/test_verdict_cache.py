@@ -0,0 +1,41 @@
+import io
+import json
+from unittest import mock
+from processor.common.verdict_cache import VerdictCache, CLEAN
+
+
+def test_memory():
+    cache = VerdictCache(size=2)
+    assert cache.get('a', '1') is None
+    cache.put('a', '1', CLEAN)
+    cache.put('b', '1', 'Eicar-Test-Signature')
+    assert cache.get('a', '1') == CLEAN
+    # least recently used verdict is evicted
+    cache.put('c', '1', CLEAN)
+    assert cache.get('b', '1') is None
+    assert cache.get('a', '1') == CLEAN
+    assert cache.get('c', '1') == CLEAN
+    # definitions update invalidates all the verdicts
+    assert cache.get('a', '2') is None
+    cache.set_version('1')
+    assert cache.get('a', '1') is None
+
+
+def test_filestore():
+    filestore = mock.MagicMock()
+    cache = VerdictCache(size=10, filestore=filestore)
+    filestore.get.return_value = None
+    assert cache.get('a', '1') is None
+    filestore.get.assert_called_once_with(key='1/a')
+
+    cache.put('a', '1', CLEAN)
+    assert filestore.post.call_args[1]['key'] == '1/a'
+    assert json.loads(filestore.post.call_args[1]['body'])['verdict'] == CLEAN
+
+    # verdict found in the shared filestore is kept in memory
+    other = VerdictCache(size=10, filestore=filestore)
+    filestore.get.reset_mock()
+    filestore.get.return_value = {'Body': io.BytesIO(json.dumps(dict(verdict=CLEAN)).encode())}
+    assert other.get('a', '1') == CLEAN
+    assert other.get('a', '1') == CLEAN
+    filestore.get.assert_called_once()
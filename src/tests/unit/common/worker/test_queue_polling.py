@@ -0,0 +1,428 @@
+import os
+import json
+import time
+import signal
+import threading
+import pytest
+from unittest import mock
+from processor.common.worker.queue_polling import QueuePollingWorker
+
+
+def create_message(index):
+    message = mock.MagicMock()
+    message.id = f'id-{index}'
+    message.body = f'body-{index}'
+    message.receipt_handle = f'handle-{index}'
+    return message
+
+
+def test_batch():
+    queue_dao = mock.MagicMock()
+    messages = [create_message(index) for index in range(4)]
+    queue_dao.get_many.return_value = messages
+    queue_dao.delete_many.return_value = []
+
+    worker = QueuePollingWorker(queue_dao=queue_dao)
+    worker.MESSAGE_BATCH_SIZE = 4
+    # odd messages fail and must not be deleted
+    worker.process_message = lambda message: int(message.id[-1]) % 2 == 0
+
+    assert next(worker)
+    queue_dao.get_many.assert_called_once_with(
+        max_messages=4,
+        wait_time=worker.MESSAGE_WAIT_TIME,
+        visibility_timeout=worker.MESSAGE_VISIBILITY_TIMEOUT
+    )
+    queue_dao.delete_many.assert_called_once_with(messages=[messages[0], messages[2]])
+
+    # failed deletes are only reported
+    queue_dao.delete_many.reset_mock()
+    queue_dao.delete_many.return_value = [(messages[0], {'Code': 'ReceiptHandleIsInvalid'})]
+    assert next(worker)
+    queue_dao.delete_many.assert_called_once()
+
+    # nothing to delete when queue is empty
+    queue_dao.delete_many.reset_mock()
+    queue_dao.get_many.return_value = []
+    assert not next(worker)
+    queue_dao.delete_many.assert_not_called()
+
+
+def test_concurrency():
+    queue_dao = mock.MagicMock()
+    queue_dao.delete_many.return_value = []
+    messages = [create_message(index) for index in range(6)]
+
+    def get_many(max_messages=None, **kwargs):
+        batch = messages[:max_messages]
+        del messages[:max_messages]
+        return batch
+    queue_dao.get_many.side_effect = get_many
+
+    started = threading.Barrier(3, timeout=5)
+    threads = set()
+
+    def process_message(message):
+        threads.add(threading.current_thread().name)
+        # all the in flight messages must be processed at the same time
+        started.wait()
+        return message.id != 'id-5'
+
+    worker = QueuePollingWorker(queue_dao=queue_dao)
+    worker.MESSAGE_BATCH_SIZE = 10
+    worker.CONCURRENCY = 3
+    worker.process_message = process_message
+
+    assert worker.max_in_flight_messages == 10
+    worker.MAX_IN_FLIGHT_MESSAGES = 3
+    assert next(worker)
+    # in flight limit caps the batch size
+    assert queue_dao.get_many.call_args[1]['max_messages'] == 3
+    while messages:
+        next(worker)
+    worker.stop()
+    assert len(threads) == 3
+    deleted = [
+        message.id
+        for call in queue_dao.delete_many.call_args_list
+        for message in call[1]['messages']
+    ]
+    assert sorted(deleted) == ['id-0', 'id-1', 'id-2', 'id-3', 'id-4']
+
+
+def test_in_flight_wait():
+    queue_dao = mock.MagicMock()
+    queue_dao.delete_many.return_value = []
+    queue_dao.get_many.side_effect = [[create_message(0)]] + [[]] * 100
+
+    def process_message(message):
+        time.sleep(0.5)
+        return True
+
+    worker = QueuePollingWorker(queue_dao=queue_dao)
+    worker.CONCURRENCY = 2
+    worker.process_message = process_message
+
+    assert next(worker)
+    # busy worker waits for the message instead of polling the empty queue
+    assert not next(worker)
+    assert queue_dao.get_many.call_count == 2
+    assert queue_dao.get_many.call_args[1]['wait_time'] == 0
+    assert worker.stats['messages_processed'] == 1
+    # empty receives of the busy worker are not idle ones
+    assert worker.stats['empty_receives'] == 1
+    assert worker.consecutive_empty_receives == 0
+    worker.stop()
+
+
+def test_unexpected_error():
+    queue_dao = mock.MagicMock()
+    queue_dao.get_many.return_value = [create_message(0)]
+    worker = QueuePollingWorker(queue_dao=queue_dao)
+    worker.process_message = mock.MagicMock(side_effect=Exception())
+    assert next(worker)
+    queue_dao.delete_many.assert_not_called()
+
+
+def test_heartbeat():
+    queue_dao = mock.MagicMock()
+    queue_dao.get_many.return_value = [create_message(0), create_message(1)]
+    queue_dao.delete_many.return_value = []
+    queue_dao.change_visibility_many.return_value = []
+
+    def process_message(message):
+        # long running processing, visibility must be extended
+        time.sleep(0.3)
+        return message.id == 'id-0'
+
+    worker = QueuePollingWorker(queue_dao=queue_dao)
+    worker.MESSAGE_BATCH_SIZE = 2
+    worker.MESSAGE_VISIBILITY_TIMEOUT = 0.1
+    worker.MESSAGE_HEARTBEAT_INTERVAL = 0.05
+    worker.process_message = process_message
+
+    assert next(worker)
+    timeouts = [call[1]['timeout'] for call in queue_dao.change_visibility_many.call_args_list]
+    assert 0.1 in timeouts
+    # failed message released right away
+    assert timeouts[-1] == 0
+    assert queue_dao.change_visibility_many.call_args[1]['messages'] == [queue_dao.get_many.return_value[1]]
+    queue_dao.delete_many.assert_called_once_with(messages=[queue_dao.get_many.return_value[0]])
+
+    # completed messages are not extended
+    worker.stop()
+    queue_dao.change_visibility_many.reset_mock()
+    worker.extend_visibility()
+    queue_dao.change_visibility_many.assert_not_called()
+
+    # visibility can't be extended beyond max visibility timeout
+    worker.MESSAGE_MAX_VISIBILITY_TIMEOUT = 0.17
+    assert next(worker)
+    timeouts = [call[1]['timeout'] for call in queue_dao.change_visibility_many.call_args_list]
+    assert timeouts.count(0.1) == 1
+    worker.stop()
+
+    # messages would become visible before the first extension
+    class SlowHeartbeatWorker(QueuePollingWorker):
+        MESSAGE_VISIBILITY_TIMEOUT = 30
+        MESSAGE_HEARTBEAT_INTERVAL = 30
+    with pytest.raises(ValueError):
+        SlowHeartbeatWorker(queue_dao=queue_dao)
+
+
+def test_idle_backoff():
+    queue_dao = mock.MagicMock()
+    queue_dao.get_many.return_value = []
+    worker = QueuePollingWorker(queue_dao=queue_dao)
+    worker.stopping = mock.MagicMock()
+    worker.stopping.is_set.return_value = False
+    sleep = worker.stopping.wait
+    worker.MESSAGE_WAIT_TIME = 1
+    worker.MESSAGE_IDLE_WAIT_TIME = 30
+    worker.IDLE_BACKOFF_THRESHOLD = 2
+    worker.IDLE_BACKOFF_BASE = 1
+    worker.IDLE_BACKOFF_MAX = 4
+
+    def wait_time():
+        return queue_dao.get_many.call_args[1]['wait_time']
+
+    assert not next(worker)
+    assert wait_time() == 1
+    # long polling limited by SQS max wait time
+    assert not next(worker)
+    assert wait_time() == 20
+    sleep.assert_not_called()
+    for i in range(10):
+        assert not next(worker)
+        assert wait_time() == 20
+    assert sleep.call_count == 10
+    delays = [call[0][0] for call in sleep.call_args_list]
+    assert all(0 <= delay <= 4 for delay in delays)
+    assert worker.consecutive_empty_receives == 12
+    assert worker.stats['empty_receives'] == 12
+    assert worker.stats['receives'] == 12
+
+    # message resets polling
+    sleep.reset_mock()
+    queue_dao.get_many.return_value = [create_message(0)]
+    queue_dao.delete_many.return_value = []
+    assert next(worker)
+    assert worker.consecutive_empty_receives == 0
+    assert next(worker)
+    assert wait_time() == 1
+    assert sleep.call_count == 1
+    assert worker.stats['messages_processed'] == 2
+
+
+def test_graceful_stop():
+    queue_dao = mock.MagicMock()
+    queue_dao.delete_many.return_value = []
+    queue_dao.change_visibility_many.return_value = []
+
+    def long_polling(messages):
+        calls = iter([messages])
+
+        def get_many(**kwargs):
+            try:
+                return next(calls)
+            except StopIteration:
+                # signal arrives during the long polling
+                worker.stopping.wait(5)
+                return []
+        return get_many
+
+    def process_message(message):
+        os.kill(os.getpid(), signal.SIGTERM)
+        return True
+
+    # message being processed in the polling thread finishes before exit
+    messages = [create_message(0)]
+    queue_dao.get_many.side_effect = long_polling(messages)
+    worker = QueuePollingWorker(queue_dao=queue_dao)
+    worker.process_message = process_message
+    handler = signal.getsignal(signal.SIGTERM)
+    assert worker.start()
+    assert signal.getsignal(signal.SIGTERM) is handler
+    queue_dao.delete_many.assert_called_once_with(messages=messages)
+    queue_dao.change_visibility_many.assert_not_called()
+
+    # the rest of the batch processed in the polling thread is not started
+    queue_dao.reset_mock()
+    messages = [create_message(index) for index in range(5)]
+    queue_dao.get_many.side_effect = long_polling(messages)
+    started = []
+
+    def first_process_message(message):
+        started.append(message)
+        os.kill(os.getpid(), signal.SIGTERM)
+        return True
+
+    worker = QueuePollingWorker(queue_dao=queue_dao)
+    worker.MESSAGE_BATCH_SIZE = 5
+    worker.process_message = first_process_message
+    worker.start()
+    assert started == messages[:1]
+    queue_dao.delete_many.assert_called_once_with(messages=messages[:1])
+    queue_dao.change_visibility_many.assert_called_once_with(messages=messages[1:], timeout=0)
+    assert worker.stats['messages_released'] == 4
+
+    # unfinished messages released after shutdown timeout, queued messages are not started
+    queue_dao.reset_mock()
+    messages = [create_message(index) for index in range(4)]
+    queue_dao.get_many.side_effect = long_polling(messages)
+    finish = threading.Event()
+    started = []
+
+    def slow_process_message(message):
+        started.append(message)
+        if message.id == 'id-0':
+            return True
+        os.kill(os.getpid(), signal.SIGTERM)
+        finish.wait(5)
+        return True
+
+    worker = QueuePollingWorker(queue_dao=queue_dao)
+    worker.CONCURRENCY = 2
+    worker.MESSAGE_BATCH_SIZE = 4
+    worker.SHUTDOWN_TIMEOUT = 0.2
+    worker.process_message = slow_process_message
+    worker.start()
+    finish.set()
+    assert len(started) == 3
+    deleted = [message for call in queue_dao.delete_many.call_args_list for message in call[1]['messages']]
+    assert deleted == [messages[0]]
+    released = queue_dao.change_visibility_many.call_args[1]
+    assert released['timeout'] == 0
+    assert sorted(message.id for message in released['messages']) == ['id-1', 'id-2', 'id-3']
+    assert worker.stats['messages_released'] == 3
+
+    # messages received after the stop signal are released
+    queue_dao.reset_mock()
+    queue_dao.get_many.side_effect = None
+    queue_dao.get_many.return_value = messages
+    worker = QueuePollingWorker(queue_dao=queue_dao)
+    worker.stopping.set()
+    assert next(worker)
+    queue_dao.change_visibility_many.assert_called_once_with(messages=messages, timeout=0)
+    queue_dao.delete_many.assert_not_called()
+    assert worker.stats['messages_released'] == 4
+
+
+def test_start_failure():
+    queue_dao = mock.MagicMock()
+    queue_dao.get_many.side_effect = ConnectionError('queue is unreachable')
+    worker = QueuePollingWorker(queue_dao=queue_dao)
+    # worker failed, it did not stop on the signal or limit
+    assert not worker.start()
+
+    worker.wait_until_ready = lambda: False
+    assert not worker.start()
+    queue_dao.get_many.assert_called_once()
+
+
+def test_prefetch():
+    queue_dao = mock.MagicMock()
+    messages = [create_message(index) for index in range(4)]
+    queue_dao.get_many.side_effect = [messages[:2], messages[2:], [], []]
+    queue_dao.delete_many.return_value = []
+    queue_dao.change_visibility_many.return_value = []
+    events = []
+    lock = threading.Lock()
+
+    def log(*event):
+        with lock:
+            events.append(event)
+
+    def prefetch_message(message):
+        log('prefetch', message.id, threading.current_thread().name)
+        if message.id == 'id-3':
+            raise ValueError()
+        return message.id
+
+    def process_message(message):
+        if message.id == 'id-2':
+            # prefetched result is not used
+            return False
+        result = worker.get_prefetched(message)
+        log('process', result, threading.current_thread().name)
+        time.sleep(0.1)
+        return True
+
+    worker = QueuePollingWorker(queue_dao=queue_dao)
+    worker.MESSAGE_BATCH_SIZE = 2
+    worker.PREFETCH_DEPTH = 2
+    worker.prefetch_message = prefetch_message
+    worker.process_message = process_message
+    worker.discard_prefetch_result = mock.MagicMock()
+
+    assert worker.max_in_flight_messages == 4
+    next(worker)
+    next(worker)
+    worker.stop()
+    # messages processed one by one while all of them are prefetched in parallel threads
+    prefetched = [event for event in events if event[0] == 'prefetch']
+    processed = [event for event in events if event[0] == 'process']
+    assert len(prefetched) == 4
+    assert all('Prefetch' in event[2] for event in prefetched)
+    assert [event[1] for event in processed] == ['id-0', 'id-1']
+    assert events.index(prefetched[-1]) < events.index(processed[-1])
+    # unused prefetched result is discarded once prefetching completes
+    for i in range(10):
+        if worker.discard_prefetch_result.called:
+            break
+        time.sleep(0.1)
+    worker.discard_prefetch_result.assert_called_once_with(messages[2], 'id-2')
+    assert worker.stats['messages_processed'] == 2
+    assert worker.stats['messages_failed'] == 2
+
+
+def test_poison_message():
+    queue_dao = mock.MagicMock()
+    queue_dao.name = 'virus-scanning'
+    queue_dao.delete_many.return_value = []
+    queue_dao.change_visibility_many.return_value = []
+    parking_queue_dao = mock.MagicMock()
+    messages = [create_message(index) for index in range(3)]
+    for receive_count, message in enumerate(messages, start=1):
+        message.receive_count = receive_count
+    queue_dao.get_many.return_value = messages
+
+    def process_message(message):
+        if message.id == 'id-2':
+            raise Exception('stderr output')
+        return False
+
+    worker = QueuePollingWorker(queue_dao=queue_dao, parking_queue_dao=parking_queue_dao)
+    worker.MESSAGE_BATCH_SIZE = 3
+    worker.MESSAGE_MAX_RECEIVE_COUNT = 3
+    worker.MESSAGE_RETRY_BACKOFF_BASE = 10
+    worker.MESSAGE_RETRY_BACKOFF_MAX = 15
+    worker.process_message = process_message
+
+    assert next(worker)
+    # message failed too many times is parked with the failure reason and deleted
+    parked = json.loads(parking_queue_dao.post.call_args[1]['body'])
+    assert parked == dict(
+        queue='virus-scanning',
+        message_id='id-2',
+        receive_count=3,
+        reason='Exception: stderr output',
+        body='body-2'
+    )
+    queue_dao.delete_many.assert_called_once_with(messages=[messages[2]])
+    assert worker.stats['messages_parked'] == 1
+    # other failed messages are delayed exponentially
+    delayed = sorted(
+        (call[1]['timeout'], [message.id for message in call[1]['messages']])
+        for call in queue_dao.change_visibility_many.call_args_list
+    )
+    assert delayed == [(10, ['id-0']), (15, ['id-1'])]
+
+    # message stays in the queue if parking fails
+    queue_dao.reset_mock()
+    parking_queue_dao.post.side_effect = Exception()
+    assert next(worker)
+    queue_dao.delete_many.assert_not_called()
+    delayed = queue_dao.change_visibility_many.call_args_list[-1][1]
+    assert delayed['timeout'] == 15
+    assert messages[2] in delayed['messages']
@@ -0,0 +1,83 @@
+import os
+import time
+import threading
+import collections
+from processor.common.worker.supervisor import WorkerSupervisor
+
+
+class Worker:
+
+    MAX_MESSAGES = 0
+    MAX_MEMORY = 0
+
+    def __init__(self):
+        self.stats = collections.Counter()
+
+    def start(self):
+        time.sleep(0.1)
+        self.stats['messages_processed'] += self.MAX_MESSAGES
+        return True
+
+
+class FailingWorker(Worker):
+
+    def start(self):
+        # e.g. queue can't be reached
+        self.stats['receives'] += 1
+        return False
+
+
+class CrashingWorker(Worker):
+
+    def start(self):
+        os._exit(1)
+
+
+def test():
+    supervisor = WorkerSupervisor(
+        worker_factory=Worker,
+        processes=2,
+        max_messages=5
+    )
+    supervisor.CHECK_INTERVAL = 0.05
+    timer = threading.Timer(1, supervisor.stop)
+    timer.start()
+    supervisor.start()
+    timer.join()
+    assert not supervisor.workers
+    # workers exited after reaching the limit and were restarted
+    assert supervisor.stats['restarts'] >= 2
+    assert supervisor.stats['messages_processed'] >= 5 * 2
+    assert supervisor.stats['crashes'] == 0
+
+
+def test_crash():
+    supervisor = WorkerSupervisor(
+        worker_factory=CrashingWorker,
+        processes=1
+    )
+    supervisor.CHECK_INTERVAL = 0.05
+    supervisor.RESTART_DELAY = 0.1
+    timer = threading.Timer(0.5, supervisor.stop)
+    timer.start()
+    supervisor.start()
+    timer.join()
+    assert supervisor.stats['crashes'] >= 1
+    assert 'messages_processed' not in supervisor.stats
+
+
+def test_failed_worker():
+    supervisor = WorkerSupervisor(
+        worker_factory=FailingWorker,
+        processes=1
+    )
+    supervisor.CHECK_INTERVAL = 0.05
+    supervisor.RESTART_DELAY = 0.2
+    timer = threading.Timer(0.5, supervisor.stop)
+    timer.start()
+    supervisor.start()
+    timer.join()
+    # failed worker is restarted after the delay
+    assert 1 <= supervisor.stats['crashes'] <= 3
+    assert supervisor.stats['restarts'] <= 3
+    assert supervisor.stats['receives'] >= 1
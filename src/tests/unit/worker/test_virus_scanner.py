@@ -0,0 +1,249 @@
+import io
+import os
+import json
+import time
+import pytest
+import datetime
+import tempfile
+from unittest import mock
+from processor.dao import conf
+from processor.common import event
+from processor.common.verdict_cache import VerdictCache
+from processor.worker.virus_scanner import VirusScannerWorker, ScanTimeout, ClamdTimeout
+
+
+def create_message(size):
+    message = mock.MagicMock()
+    message.body = event.create_minimal_valid_file_put_event(
+        key='user/2019-01-02T00:00:00+11:00-5cd7cc6.json',
+        etag='etag',
+        size=size,
+        bucket=conf.UNPROCESSED_BUCKET,
+        event_time=datetime.datetime(2019, 1, 2)
+    )
+    message.receive_count = 1
+    message.received = time.monotonic()
+    return message
+
+
+def test_large_files_routing():
+    large_files_queue_dao = mock.MagicMock()
+    worker = VirusScannerWorker(
+        virus_scanning_queue_dao=mock.MagicMock(),
+        unprocessed_filestore_dao=mock.MagicMock(),
+        large_files_queue_dao=large_files_queue_dao
+    )
+    worker.LARGE_FILE_SIZE = 100
+    worker.scan_message = mock.MagicMock()
+
+    # large file event is forwarded without downloading the file
+    message = create_message(101)
+    assert worker.prefetch_message(message) is None
+    assert worker.process_message(message)
+    large_files_queue_dao.post.assert_called_once_with(body=message.body, delay=0)
+    worker.unprocessed_filestore_dao.download.assert_not_called()
+    worker.scan_message.assert_not_called()
+    assert worker.stats['messages_routed'] == 1
+
+    # small file is scanned
+    message = create_message(100)
+    assert worker.process_message(message)
+    worker.scan_message.assert_called_once()
+    assert large_files_queue_dao.post.call_count == 1
+
+    # routing is disabled
+    worker.LARGE_FILE_SIZE = 0
+    assert worker.process_message(create_message(101))
+    assert worker.scan_message.call_count == 2
+    assert large_files_queue_dao.post.call_count == 1
+
+
+def test_wait_until_ready():
+    worker = VirusScannerWorker(
+        virus_scanning_queue_dao=mock.MagicMock(),
+        unprocessed_filestore_dao=mock.MagicMock()
+    )
+    worker.clamd = mock.MagicMock()
+    worker.clamd.ping.side_effect = [ConnectionRefusedError(), True]
+    worker.stopping.wait = mock.MagicMock()
+    assert worker.wait_until_ready()
+    assert worker.clamd.ping.call_count == 2
+    worker.clamd.version.assert_called_once()
+
+    # clamd is not started in time
+    worker.CLAMD_STARTUP_TIMEOUT = 0
+    worker.clamd.ping.side_effect = FileNotFoundError()
+    assert not worker.wait_until_ready()
+
+    # stopped while waiting
+    worker.stopping.set()
+    assert not worker.wait_until_ready()
+
+
+def test_published_definitions_version():
+    worker = VirusScannerWorker(
+        virus_scanning_queue_dao=mock.MagicMock(),
+        unprocessed_filestore_dao=mock.MagicMock()
+    )
+    worker.clamd = mock.MagicMock()
+    worker.clamd.version.return_value = 'ClamAV 0.102.4/25000/Mon Oct 19 12:00:00 2026'
+    with tempfile.TemporaryDirectory() as dirname:
+        worker.DEFINITIONS_VERSION_FILE = os.path.join(dirname, 'version')
+        # not published yet
+        assert worker.get_definitions_version() == '25000'
+        with open(worker.DEFINITIONS_VERSION_FILE, 'w') as f:
+            f.write('25001')
+        assert worker.get_definitions_version() == '25001'
+        # published version is used right away
+        with open(worker.DEFINITIONS_VERSION_FILE, 'w') as f:
+            f.write('25002')
+        os.utime(worker.DEFINITIONS_VERSION_FILE, ns=(1, 1))
+        assert worker.get_definitions_version() == '25002'
+    worker.clamd.version.assert_called_once()
+
+
+def test_reloading_endpoints():
+    worker = VirusScannerWorker(
+        virus_scanning_queue_dao=mock.MagicMock(),
+        unprocessed_filestore_dao=mock.MagicMock()
+    )
+    worker.clamd = mock.MagicMock()
+    with tempfile.TemporaryDirectory() as dirname:
+        worker.DEFINITIONS_VERSION_FILE = os.path.join(dirname, 'version')
+        path = f'{worker.DEFINITIONS_VERSION_FILE}.reloading'
+        # nothing is reloading
+        worker.update_reloading_endpoints()
+        worker.clamd.set_reloading.assert_called_with([])
+        with open(path, 'w') as f:
+            json.dump(dict(endpoint='clamd-1:3310', until=time.time() + 60), f)
+        worker.update_reloading_endpoints()
+        worker.clamd.set_reloading.assert_called_with(['clamd-1:3310'])
+        # state of the crashed updater expires
+        with open(path, 'w') as f:
+            json.dump(dict(endpoint='clamd-1:3310', until=time.time() - 1), f)
+        os.utime(path, ns=(1, 1))
+        worker.update_reloading_endpoints()
+        worker.clamd.set_reloading.assert_called_with([])
+        with open(path, 'w') as f:
+            json.dump(dict(endpoint='clamd-2:3310', until=time.time() + 60), f)
+        worker.update_reloading_endpoints()
+        worker.clamd.set_reloading.assert_called_with(['clamd-2:3310'])
+        # reload is completed
+        os.remove(path)
+        worker.update_reloading_endpoints()
+        worker.clamd.set_reloading.assert_called_with([])
+
+
+def test_stream_file_too_large():
+    worker = VirusScannerWorker(
+        virus_scanning_queue_dao=mock.MagicMock(),
+        unprocessed_filestore_dao=mock.MagicMock()
+    )
+    worker.SCAN_ENGINE = 'clamd'
+    worker.clamd = mock.MagicMock()
+
+    def instream(stream, **kwargs):
+        while stream.read(16):
+            pass
+        return None
+    worker.clamd.instream.side_effect = instream
+    worker.move_to_qurantine = mock.MagicMock()
+    worker.send_virus_notification = mock.MagicMock()
+
+    # object larger than the event says is not hashed in memory but streamed
+    for cache_size, buffer_size in [(0, 1024), (10, 10)]:
+        worker.verdict_cache = VerdictCache(size=cache_size) if cache_size else None
+        worker.VERDICT_CACHE_STREAM_BUFFER_SIZE = buffer_size
+        worker.unprocessed_filestore_dao.stream.return_value = io.BytesIO(b'x' * 101)
+        assert worker.process_message(create_message(100))
+        worker.send_virus_notification.assert_called_once_with(mock.ANY, 'file too large')
+        worker.send_virus_notification.reset_mock()
+
+    # object of the expected size is clean
+    worker.unprocessed_filestore_dao.stream.return_value = io.BytesIO(b'x' * 100)
+    worker.forward_to_validator = mock.MagicMock()
+    assert worker.process_message(create_message(100))
+    worker.send_virus_notification.assert_not_called()
+    worker.forward_to_validator.assert_called_once()
+
+
+def test_scan_timeout():
+    worker = VirusScannerWorker(
+        virus_scanning_queue_dao=mock.MagicMock(),
+        unprocessed_filestore_dao=mock.MagicMock()
+    )
+    worker.SCAN_TIMEOUT = 10
+    worker.MESSAGE_VISIBILITY_TIMEOUT = 0
+    worker.MESSAGE_HEARTBEAT_INTERVAL = 0
+    message = create_message(100)
+    assert worker.get_scan_timeout(message) == 10
+    # timed out file gets a longer time on each retry
+    message.receive_count = 3
+    assert worker.get_scan_timeout(message) == 40
+
+    # scan must be completed before the message becomes visible again
+    worker.MESSAGE_VISIBILITY_TIMEOUT = 30
+    assert 29 < worker.get_scan_timeout(message) <= 30
+    worker.SCAN_TIMEOUT = 0
+    assert 29 < worker.get_scan_timeout(message) <= 30
+    # heartbeat keeps the message invisible
+    worker.MESSAGE_HEARTBEAT_INTERVAL = 10
+    worker.SCAN_TIMEOUT = 10
+    assert worker.get_scan_timeout(message) == 40
+    worker.MESSAGE_HEARTBEAT_INTERVAL = 0
+    message.received = time.monotonic() - 31
+    with pytest.raises(ScanTimeout):
+        worker.get_scan_timeout(message)
+
+    # no limit
+    worker.MESSAGE_VISIBILITY_TIMEOUT = 0
+    worker.SCAN_TIMEOUT = 0
+    assert worker.get_scan_timeout(message) is None
+
+    # scan command is killed
+    worker.VIRUS_SCAN_COMMAND = ['sleep', '{path}']
+    start_time = time.monotonic()
+    with pytest.raises(ScanTimeout):
+        worker.run_scan_command('5', timeout=0.1)
+    assert time.monotonic() - start_time < 5
+
+    # clamd scan times out
+    worker.clamd = mock.MagicMock()
+    worker.clamd.instream.side_effect = ClamdTimeout('Scan is not completed in 10 seconds')
+    worker.verdict_cache = None
+    worker.unprocessed_filestore_dao.stream.return_value = io.BytesIO(b'x' * 100)
+    s3_event = event.loads_s3_unprocessed_bucket_object_created_event(create_message(100).body)
+    with pytest.raises(ScanTimeout):
+        worker.stream_file(s3_event, timeout=10)
+    assert worker.clamd.instream.call_args[1]['timeout'] == 10
+
+
+def test_scan_timeout_quarantine():
+    worker = VirusScannerWorker(
+        virus_scanning_queue_dao=mock.MagicMock(),
+        unprocessed_filestore_dao=mock.MagicMock()
+    )
+    worker.SCAN_TIMEOUT_MAX_TRIES = 2
+    worker.scan_message = mock.MagicMock(side_effect=ScanTimeout('Scan is not completed in 10 seconds'))
+    worker.move_to_qurantine = mock.MagicMock()
+    worker.send_virus_notification = mock.MagicMock()
+
+    # timed out scan is retried
+    message = create_message(100)
+    assert not worker.process_message(message)
+    worker.move_to_qurantine.assert_not_called()
+    assert worker.stats['scan_timeouts'] == 1
+
+    # file is quarantined once its scan timed out SCAN_TIMEOUT_MAX_TRIES times
+    message.receive_count = 2
+    assert worker.process_message(message)
+    worker.move_to_qurantine.assert_called_once()
+    worker.send_virus_notification.assert_called_once_with(mock.ANY, 'scan timed out')
+    assert worker.stats['scan_timeouts'] == 2
+    assert worker.stats['scan_timeouts_quarantined'] == 1
+
+    # no limit
+    worker.SCAN_TIMEOUT_MAX_TRIES = 0
+    message.receive_count = 10
+    assert not worker.process_message(message)
+    worker.move_to_qurantine.assert_called_once()